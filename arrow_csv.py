@@ -0,0 +1,156 @@
+# multi-threaded csv parsing with the pyarrow csv reader, an optional dependency: without pyarrow
+# installed ARROW_AVAILABLE is False and s3_to_kinesis keeps parsing with pandas.
+# the reader takes single character delimiters only, the regex separator of the space format is
+# left to pandas. pyarrow (and pandas) are imported once a source is parsed with pyarrow, see _import_arrow
+import importlib.util
+
+ARROW_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+pa = None
+pa_csv = None
+pd = None
+
+# size of the csv blocks parsed by the threads of the reader, one record batch per block when streaming
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def _import_arrow():
+    global pa, pa_csv, pd
+    if pa_csv is None:
+        import pandas as pd
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+
+
+# arrow types of the types in the column_types config
+def _arrow_types():
+    return {'string': pa.string(), 'int': pa.int64(), 'float': pa.float64(), 'bool': pa.bool_(),
+            'category': pa.dictionary(pa.int32(), pa.string())}
+
+
+# keeps the nullable pandas dtypes the pandas parser gives typed int and bool columns
+def _types_mapper(arrow_type):
+    if arrow_type == pa.int64():
+        return pd.Int64Dtype()
+    if arrow_type == pa.bool_():
+        return pd.BooleanDtype()
+    return None
+
+
+# pyarrow reader options for a source, the counterpart of the read_csv options of get_parse_options:
+# column_names are the names of all the columns of a file without header (None with a header), usecols the
+# columns to parse and column_types the type names of columns. in a typed source (column_types or
+# raw_strings) the columns without a type are parsed as strings like pandas does, usecols are returned in
+# the order of the file. both need the names of the columns: with a header the options are completed by
+# the names of its header line once a source is opened (see _open_source).
+# returns (read options, parse options, convert options, the arguments to complete them with, or None)
+def get_arrow_options(delimiter, column_names=None, usecols=None, column_types=None, raw_strings=False,
+                      block_size=DEFAULT_BLOCK_SIZE):
+    _import_arrow()
+    if column_names is None and (usecols or column_types or raw_strings):
+        read_options = pa_csv.ReadOptions(use_threads=True, block_size=block_size)
+        return (read_options, pa_csv.ParseOptions(delimiter=delimiter), None,
+                (delimiter, usecols, column_types, raw_strings, block_size))
+    arrow_types = _arrow_types()
+    typed = bool(column_types or raw_strings)
+    # as the na_filter of pandas, off for raw strings without types
+    strings_can_be_null = not raw_strings or bool(column_types)
+    column_types = {name: arrow_types[type_name] for (name, type_name) in (column_types or {}).items()}
+    if column_names and usecols:
+        unknown = [name for name in usecols if name not in column_names]
+        if unknown:
+            raise ValueError("usecols {} are not in the columns {}".format(unknown, column_names))
+        usecols = [name for name in column_names if name in usecols]
+    if typed and column_names:
+        for name in usecols or column_names:
+            column_types.setdefault(name, pa.string())
+    read_options = pa_csv.ReadOptions(column_names=column_names, use_threads=True, block_size=block_size)
+    parse_options = pa_csv.ParseOptions(delimiter=delimiter)
+    convert_options = pa_csv.ConvertOptions(column_types=column_types, include_columns=usecols,
+                                            strings_can_be_null=strings_can_be_null)
+    return read_options, parse_options, convert_options, None
+
+
+# the rest of a stream once its header line was read, starting with the bytes read past the header
+class _RestOfStream:
+    def __init__(self, buffered, stream):
+        self.buffered = buffered
+        self.stream = stream
+        self.closed = False
+
+    def read(self, size=-1):
+        if not self.buffered:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            (data, self.buffered) = (self.buffered + self.stream.read(), b'')
+        else:
+            (data, self.buffered) = (self.buffered[:size], self.buffered[size:])
+        return data
+
+
+# opens a source (stream or local path) for the reader with its options. a file with a header whose
+# options need the column names has its header line read here and the reader continues after it
+# returns (source, (read options, parse options, convert options), the column names of an empty file or None)
+def _open_source(source, arrow_options):
+    (read_options, parse_options, convert_options, header_arguments) = arrow_options
+    if header_arguments is None:
+        return source, (read_options, parse_options, convert_options), None
+    import csv
+    if isinstance(source, str):
+        source = pa.input_stream(source, compression='detect')
+    data = b''
+    while b'\n' not in data:
+        block = source.read(read_options.block_size)
+        if not block:
+            break
+        data = data + block
+    (line, _, data) = data.partition(b'\n')
+    if not data:
+        data = source.read(read_options.block_size)
+    (delimiter, usecols, column_types, raw_strings, block_size) = header_arguments
+    column_names = next(csv.reader([line.decode('utf-8').rstrip('\r')], delimiter=delimiter), [])
+    options = get_arrow_options(delimiter, column_names, usecols, column_types, raw_strings, block_size)
+    empty_columns = None
+    if not data:
+        empty_columns = [name for name in column_names if not usecols or name in usecols]
+    return _RestOfStream(data, source), options[:3], empty_columns
+
+
+# reads a whole csv stream (or local path) into a dataframe, the blocks are parsed by all the cores
+def read_csv(source, arrow_options):
+    _import_arrow()
+    (source, (read_options, parse_options, convert_options), empty_columns) = _open_source(source, arrow_options)
+    if empty_columns is not None:
+        return pd.DataFrame(columns=empty_columns)
+    table = pa_csv.read_csv(source, read_options=read_options, parse_options=parse_options,
+                            convert_options=convert_options)
+    return table.to_pandas(types_mapper=_types_mapper)
+
+
+# streams a csv stream (or local path) as dataframes, one per block of the reader, or of chunk_rows
+# rows when chunk_rows is set
+def iter_csv_chunks(source, arrow_options, chunk_rows=None):
+    _import_arrow()
+    (source, (read_options, parse_options, convert_options), empty_columns) = _open_source(source, arrow_options)
+    if empty_columns is not None:
+        return
+    reader = pa_csv.open_csv(source, read_options=read_options, parse_options=parse_options,
+                             convert_options=convert_options)
+    batches = []
+    buffered_rows = 0
+    for batch in reader:
+        if not chunk_rows:
+            yield batch.to_pandas(types_mapper=_types_mapper)
+            continue
+        batches.append(batch)
+        buffered_rows = buffered_rows + batch.num_rows
+        if buffered_rows < chunk_rows:
+            continue
+        table = pa.Table.from_batches(batches)
+        start = 0
+        while buffered_rows - start >= chunk_rows:
+            yield table.slice(start, chunk_rows).to_pandas(types_mapper=_types_mapper)
+            start = start + chunk_rows
+        batches = table.slice(start).to_batches()
+        buffered_rows = buffered_rows - start
+    if buffered_rows:
+        yield pa.Table.from_batches(batches, schema=reader.schema).to_pandas(types_mapper=_types_mapper)
@@ -7,6 +7,7 @@ import boto3
 import argparse
 import datetime as dt
 from faker import *
+from sinks import create_sink, SINK_TYPES
 
 
 
@@ -40,7 +41,8 @@ class RecordGenerator(object):
 			'manufacturer': random.choice(['3M', 'GE', 'Vyaire', 'Getinge'])
 			}
 		data = json.dumps(record)
-		return {'Data': bytes(data, 'utf-8'), 'PartitionKey': 'partition_key'}
+		# keyed by ventilator so traffic spreads over the shards and each ventilator stays on one shard
+		return {'Data': bytes(data, 'utf-8'), 'PartitionKey': str(record['ventilatorid'])}
 
 	def get_ventilator_records(self, rate, fake):
 		return [self.get_ventilator_record(fake) for _ in range(rate)]
@@ -57,19 +59,23 @@ def main():
 
     parser.add_argument('--streamname', action='store', dest='stream_name', help='Provide Kinesis Data Stream name to stream data')
     parser.add_argument('--region', action='store', dest='region', default='us-west-2')
+    # kinesis, kafka (topic --streamname on localhost:9092) or file (--streamname is the path, '-' for stdout)
+    parser.add_argument('--sink', action='store', dest='sink', choices=SINK_TYPES, default='kinesis')
 
     args = parser.parse_args()
 
     #print (args)
     # Make sure to set your profile here
     session = boto3.Session(profile_name='default')
+    sink = None
 
     try:
     	# Intialize Faker library
     	fake = Faker()
 
     	# Kinesis settings
-    	kinesis_client = session.client('kinesis', args.region)
+    	kinesis_client = session.client('kinesis', args.region) if args.sink == 'kinesis' else None
+    	sink = create_sink(args.sink, args.stream_name, kinesis_client=kinesis_client)
 
     	# Rate at which records are generated
     	rate = 500
@@ -79,7 +85,9 @@ def main():
     	while True:
     		fake_ventilator_records = generator.get_ventilator_records(rate, fake)
     		#print (fake_ventilator_records)
-    		kinesis_client.put_records(StreamName=args.stream_name, Records=fake_ventilator_records)
+    		for record in fake_ventilator_records:
+    			sink.add(record['Data'], record['PartitionKey'])
+    		sink.flush()
         #fakeIO = StringIO()
         #fakeIO.write(str(''.join(dumps_lines(fake_ventilator_records))))
         #fakeIO.close()
@@ -87,6 +95,9 @@ def main():
     except:
         print("Error:", sys.exc_info()[0])
         raise
+    finally:
+        if sink is not None:
+            print(sink.summary())
 
 if __name__ == "__main__":
 	# run main
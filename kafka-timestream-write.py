@@ -1,274 +1,14 @@
 import argparse
-import json
-import random
 import signal
-import string
 import sys
-import time
-from collections import namedtuple
 
-import numpy as np
 from kafka.producer import KafkaProducer
 
-regions = {
-    "us_east_1": dict(cells_per_region=15, silos_per_cell=3),
-    "us-east-2": dict(cells_per_region=2, silos_per_cell=2),
-    "us-west-1": dict(cells_per_region=6, silos_per_cell=2),
-    "us-west-2": dict(cells_per_region=2, silos_per_cell=2),
-    "eu-west-1": dict(cells_per_region=10, silos_per_cell=2),
-    "ap-northeast-1": dict(cells_per_region=5, silos_per_cell=3),
-}
-
-microserviceApollo = "apollo"
-microserviceAthena = "athena"
-microserviceDemeter = "demeter"
-microserviceHercules = "hercules"
-microserviceZeus = "zeus"
-microservices = [microserviceApollo, microserviceAthena, microserviceDemeter, microserviceHercules, microserviceZeus]
-
-instance_r5_4xl = "r5.4xlarge"
-instance_m5_8xl = "m5.8xlarge"
-instance_c5_16xl = "c5.16xlarge"
-instance_m5_4xl = "m5.4xlarge"
-
-instanceTypes = {
-    microserviceApollo: instance_r5_4xl,
-    microserviceAthena: instance_m5_8xl,
-    microserviceDemeter: instance_c5_16xl,
-    microserviceHercules: instance_r5_4xl,
-    microserviceZeus: instance_m5_4xl
-}
-
-osAl2 = "AL2"
-osAl2012 = "AL2012"
-
-osVersions = {
-    microserviceApollo: osAl2,
-    microserviceAthena: osAl2012,
-    microserviceDemeter: osAl2012,
-    microserviceHercules: osAl2012,
-    microserviceZeus: osAl2
-}
-
-instancesForMicroservice = {
-    microserviceApollo: 3,
-    microserviceAthena: 1,
-    microserviceDemeter: 1,
-    microserviceHercules: 2,
-    microserviceZeus: 3
-}
-
-processHostmanager = "host_manager"
-processServer = "server"
-
-processNames = {
-    microserviceApollo: [processServer],
-    microserviceAthena: [processServer, processHostmanager],
-    microserviceDemeter: [processServer, processHostmanager],
-    microserviceHercules: [processServer],
-    microserviceZeus: [processServer]
-}
-
-jdk8 = "JDK_8"
-jdk11 = "JDK_11"
-
-jdkVersions = {
-    microserviceApollo: jdk11,
-    microserviceAthena: jdk8,
-    microserviceDemeter: jdk8,
-    microserviceHercules: jdk8,
-    microserviceZeus: jdk11
-}
-
-measureCpuUser = 'cpu_user'
-measureCpuSystem = 'cpu_system'
-measureCpuIdle = 'cpu_idle'
-measureCpuIowait = 'cpu_iowait'
-measureCpuSteal = 'cpu_steal'
-measureCpuNice = 'cpu_nice'
-measureCpuSi = 'cpu_si'
-measureCpuHi = 'cpu_hi'
-measureMemoryFree = 'memory_free'
-measureMemoryUsed = 'memory_used'
-measureMemoryCached = 'memory_cached'
-measureDiskIoReads = 'disk_io_reads'
-meausreDiskIoWrites = 'disk_io_writes'
-measureLatencyPerRead = 'latency_per_read'
-measureLatencyPerWrite = 'latency_per_write'
-measureNetworkBytesIn = 'network_bytes_in'
-measureNetworkBytesOut = 'network_bytes_out'
-measureDiskUsed = 'disk_used'
-measureDiskFree = 'disk_free'
-measureFileDescriptors = 'file_descriptors_in_use'
-
-measureTaskCompleted = 'task_completed'
-measureTaskEndState = 'task_end_state'
-measureGcReclaimed = 'gc_reclaimed'
-measureGcPause = 'gc_pause'
-
-measuresForMetrics = [measureCpuUser, measureCpuSystem, measureCpuIdle, measureCpuIowait,
-                      measureCpuSteal, measureCpuNice, measureCpuSi, measureCpuHi,
-                      measureMemoryFree, measureMemoryUsed, measureMemoryCached, measureDiskIoReads,
-                      meausreDiskIoWrites, measureLatencyPerRead, measureLatencyPerWrite, measureNetworkBytesIn,
-                      measureNetworkBytesOut, measureDiskUsed, measureDiskFree, measureFileDescriptors]
-
-measuresForEvents = [measureTaskCompleted, measureTaskEndState, measureGcReclaimed, measureGcPause, measureMemoryFree]
-
-measureValuesForTaskEndState = ['SUCCESS_WITH_NO_RESULT', 'SUCCESS_WITH_RESULT', 'INTERNAL_ERROR', 'USER_ERROR',
-                                'UNKNOWN', 'THROTTLED']
-selectionProbabilities = [0.2, 0.7, 0.01, 0.07, 0.01, 0.01]
-
-DimensionsMetric = namedtuple('DimensionsMetric',
-                              'region cell silo availability_zone microservice_name instance_type os_version instance_name')
-DimensionsEvent = namedtuple('DimensionsEvent',
-                             'region cell silo availability_zone microservice_name instance_name process_name, jdk_version')
-
-utilizationRand = random.Random(12345)
-lowUtilizationHosts = []
-highUtilizationHosts = []
-
-
-def generateRandomAlphaNumericString(length=5):
-    rand = random.Random(12345)
-    x = ''.join(rand.choices(string.ascii_letters + string.digits, k=length))
-    print(x)
-    return x
-
-
-def generateDimensions(scaleFactor):
-    instancePrefix = generateRandomAlphaNumericString(8)
-    dimensionsMetrics = list()
-    dimenstionsEvents = list()
-
-    for region_name, region_data in regions.items():
-        cellsForRegion = region_data['cells_per_region']
-        siloForRegion = region_data['silos_per_cell']
-        for cell in range(1, cellsForRegion + 1):
-            for silo in range(1, siloForRegion + 1):
-                for microservice in microservices:
-                    cellName = "{}-cell-{}".format(region_name, cell)
-                    siloName = "{}-cell-{}-silo-{}".format(region_name, cell, silo)
-                    numInstances = scaleFactor * instancesForMicroservice[microservice]
-                    for instance in range(numInstances):
-                        az = "{}-{}".format(region_name, (instance % 3) + 1)
-                        instanceName = "i-{}-{}-{:04}.amazonaws.com".format(instancePrefix, microservice, instance)
-                        instanceType = instanceTypes[microservice]
-                        osVersion = osVersions[microservice]
-                        metric = DimensionsMetric(region_name, cellName, siloName, az, microservice, instanceType,
-                                                  osVersion,
-                                                  instanceName)
-                        dimensionsMetrics.append(metric)
-
-                        jdkVersion = jdkVersions[microservice]
-                        for process in processNames[microservice]:
-                            event = DimensionsEvent(region_name, cellName, siloName, az, microservice, instanceName,
-                                                    process,
-                                                    jdkVersion)
-                            dimenstionsEvents.append(event)
-
-    return (dimensionsMetrics, dimenstionsEvents)
-
-
-def createRandomMetrics(host_id, timestamp, time_unit):
-    records = list()
-
-    ## CPU measures
-    if host_id in highUtilizationHosts:
-        cpu_user = 85.0 + 10.0 * random.random()
-    elif host_id in lowUtilizationHosts:
-        cpu_user = 10.0 * random.random()
-    else:
-        cpu_user = 35.0 + 30.0 * random.random()
-
-    records.append(create_record(measureCpuUser, cpu_user, "DOUBLE", timestamp, time_unit))
-
-    otherCpuMeasures = [measureCpuSystem, measureCpuSteal, measureCpuIowait, measureCpuNice, measureCpuHi, measureCpuSi]
-    totalOtherUsage = 0.0
-
-    for measure in otherCpuMeasures:
-        value = random.random()
-        totalOtherUsage += value
-        records.append(create_record(measure, value, "DOUBLE", timestamp, time_unit))
-
-    cpuIdle = 100 - cpu_user - totalOtherUsage
-    records.append(create_record(measureCpuIdle, cpuIdle, "DOUBLE", timestamp, time_unit))
-
-    remainingMeasures = [measureMemoryFree, measureMemoryUsed, measureMemoryCached, measureDiskIoReads,
-                         meausreDiskIoWrites, measureLatencyPerRead, measureLatencyPerWrite, measureNetworkBytesIn,
-                         measureNetworkBytesOut, measureDiskUsed, measureDiskFree, measureFileDescriptors]
-
-    for measure in remainingMeasures:
-        value = 100.0 * random.random()
-        records.append(create_record(measure, value, "DOUBLE", timestamp, time_unit))
-
-    return records
-
-
-def createRandomEvent(timestamp, time_unit):
-    records = list()
-
-    records.append(create_record(measureTaskCompleted, random.randint(0, 500), "BIGINT", timestamp, time_unit))
-    records.append(
-        create_record(measureTaskEndState, np.random.choice(measureValuesForTaskEndState, p=selectionProbabilities),
-                      "VARCHAR", timestamp, time_unit))
-
-    remainingMeasures = [measureGcReclaimed, measureGcPause, measureMemoryFree]
-
-    for measure in remainingMeasures:
-        value = 100.0 * random.random()
-        records.append(create_record(measure, value, "DOUBLE", timestamp, time_unit))
-
-    return records
-
-
-def create_record(measure_name, measure_value, value_type, timestamp, time_unit):
-    return {
-        "MeasureName": measure_name,
-        "MeasureValue": str(measure_value),
-        "MeasureValueType": value_type,
-        "Time": str(timestamp),
-        "TimeUnit": time_unit
-    }
-
-
-def send_records_to_kafka(all_dimensions, producer, stream_name, sleep_time, percent_late, late_time):
-    while True:
-        if percent_late > 0:
-            value = random.random() * 100
-            if (value >= percent_late):
-                print("Generating On-Time Records.")
-                local_timestamp = int(time.time())
-            else:
-                print("Generating Late Records.")
-                local_timestamp = (int(time.time()) - late_time)
-        else:
-            local_timestamp = int(time.time())
-
-        for series_id, dimensions in enumerate(all_dimensions):
-            if isinstance(dimensions, DimensionsMetric):
-                metrics = createRandomMetrics(series_id, local_timestamp, "SECONDS")
-            else:
-                metrics = createRandomEvent(local_timestamp, "SECONDS")
-
-            dimensions = dimensions._asdict()  # convert named tuple to dict
-            records = []
-            for metric in metrics:
-                metric.update(dimensions)  # adds the dimensions into metric dict
-                future = producer.send(topic=stream_name, key=metric['instance_name'], value=metric)
-                result = future.get(timeout=60)
-
-
-            print("Wrote {} records to kafka Stream '{}'".format(len(metrics), stream_name))
-
-        if sleep_time > 0:
-            time.sleep(float(sleep_time))
+from sinks import KafkaSink, FileSink
+from timestream_data import generateDimensions, select_utilization_hosts, send_records
 
 
 def main(args):
-    global utilizationRand
-    global lowUtilizationHosts
-    global highUtilizationHosts
-
     print(args)
     host_scale = args.hostScale  # scale factor for the hosts.
 
@@ -277,10 +17,7 @@ def main(args):
     print("Dimensions for metrics: {}".format(len(dimension_measures)))
     print("Dimensions for events: {}".format(len(dimensions_events)))
 
-    host_ids = list(range(len(dimension_measures)))
-    utilizationRand.shuffle(host_ids)
-    lowUtilizationHosts = frozenset(host_ids[0:int(0.2 * len(host_ids))])
-    highUtilizationHosts = frozenset(host_ids[-int(0.2 * len(host_ids)):])
+    select_utilization_hosts(len(dimension_measures))
 
     def signal_handler(sig, frame):
         print("Exiting Application")
@@ -288,18 +25,29 @@ def main(args):
 
     signal.signal(signal.SIGINT, signal_handler)
     stream_name = args.stream
-    region_name = args.region
-    producer = KafkaProducer(bootstrap_servers=['localhost:9200'],
-                             value_serializer=lambda v: json.dumps(v).encode('utf-8'),
-                             api_version=(2,7,0))
 
-    print(producer.bootstrap_connected())
     sleep_time = args.sleep_time
     percent_late = args.percent_late
     late_time = args.late_time
 
-    send_records_to_kafka(dimension_measures + dimensions_events,
-                            producer, stream_name, sleep_time, percent_late, late_time)
+    if args.sink == 'file':
+        # the json lines of the records, to benchmark the generator without a broker
+        sink = FileSink(stream_name)
+    else:
+        # the sink sends the json of the records as bytes. the producer batches the records of a partition
+        # for up to linger_ms ms or batch_size bytes, compressed per batch
+        producer = KafkaProducer(bootstrap_servers=args.bootstrap_servers.split(","),
+                                 api_version=(2,7,0),
+                                 linger_ms=args.linger_ms,
+                                 batch_size=args.batch_size,
+                                 compression_type=args.compression,
+                                 acks=args.acks if args.acks == 'all' else int(args.acks))
+        print(producer.bootstrap_connected())
+        # the sends of a tick stay asynchronous, deliveries are counted by callbacks and the tick is flushed
+        # by send_records. at most max_outstanding records are unacknowledged at a time
+        sink = KafkaSink(producer, stream_name, max_outstanding=args.max_outstanding)
+
+    send_records(dimension_measures + dimensions_events, sink, sleep_time, percent_late, late_time)
 
 
 if __name__ == "__main__":
@@ -313,6 +61,24 @@ if __name__ == "__main__":
     parser.add_argument('--host-scale', dest="hostScale", action="store", type=int, default=1,
                         help="The scale factor determines the number of hosts emitting events and metrics.")
     parser.add_argument('--profile', action="store", type=str, default=None, help="The AWS Config profile to use.")
+    parser.add_argument('--sink', action="store", choices=['kafka', 'file'], default="kafka",
+                        help="Send to the kafka topic --stream or write json lines to the file named by --stream "
+                             "('-' for stdout).")
+    parser.add_argument('--bootstrap-servers', dest="bootstrap_servers", action="store", type=str,
+                        default="localhost:9200", help="Comma separated host:port of the kafka brokers.")
+
+    # producer tuning, sends are asynchronous and batched by the producer
+    parser.add_argument('--linger-ms', dest="linger_ms", action="store", type=int, default=20,
+                        help="Milliseconds the producer waits to fill a batch of a partition.")
+    parser.add_argument('--batch-size', dest="batch_size", action="store", type=int, default=256 * 1024,
+                        help="Upper bound in bytes of a batch of a partition.")
+    parser.add_argument('--compression', action="store", choices=['gzip', 'snappy', 'lz4', 'zstd'], default=None,
+                        help="Compression of the batches.")
+    parser.add_argument('--acks', action="store", choices=['0', '1', 'all'], default='1',
+                        help="Acknowledgements the producer requires from the brokers.")
+    parser.add_argument('--max-outstanding', dest="max_outstanding", action="store", type=int, default=100000,
+                        help="Records sent without being acknowledged before sending blocks, 0 waits for every "
+                             "batch of records.")
 
     # Optional sleep timer to slow down data
     parser.add_argument('--sleep-time', action="store", type=int, default=0,
@@ -0,0 +1,347 @@
+# helpers shared by the producers that write to kinesis data streams
+# recommended : keep kinesis specific logic here and call from the pumper scripts
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+# record formats a dataframe can be serialized to
+RECORD_FORMATS = ('json', 'pipe', 'raw')
+# put_records errors worth retrying, for the whole call or for single records
+THROTTLE_ERROR_CODES = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'KMSThrottlingException')
+RETRYABLE_ERROR_CODES = THROTTLE_ERROR_CODES + ('InternalFailure', 'ServiceUnavailable', 'LimitExceededException')
+# default retry settings for put_records_with_retry
+MAX_PUT_ATTEMPTS = 5
+BASE_RETRY_DELAY = 0.1
+MAX_RETRY_DELAY = 5.0
+# put_records api limits, the size of a record is its data plus its partition key
+MAX_RECORDS_PER_REQUEST = 500
+MAX_BYTES_PER_REQUEST = 5 * 1024 * 1024
+MAX_BYTES_PER_RECORD = 1024 * 1024
+# write limits of a single shard per second
+SHARD_RECORDS_PER_SEC = 1000
+SHARD_BYTES_PER_SEC = 1024 * 1024
+# seconds a shard count looked up with describe_stream_summary is reused
+SHARD_COUNT_TTL = 300
+# ways to pick the partition key of a record
+#   index  - the dataframe index of the row
+#   column - the value of a column (e.g. visitor id), the records of a key go to one shard. their order
+#            is not kept: failed entries are retried after later ones and several calls may be in flight
+#   hash   - explicit hash keys spread uniformly over the hash key ranges of the open shards
+#   random - a random key per record
+PARTITION_KEY_STRATEGIES = ('index', 'column', 'hash', 'random')
+MAX_PARTITION_KEY_LENGTH = 256
+
+_shard_counts = {}
+_shard_hash_ranges = {}
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+# serializes a whole dataframe to kinesis payloads in one vectorized pass instead of
+# calling data.loc[i].to_json() for each row.
+#   json - one json object per row, same layout as Series.to_json() of a row, no newlines
+#   pipe - values joined by '|' like kinesis-write.py produces, missing values are empty
+#   raw  - the bytes of the first column as they are, e.g. lines of a file passed through unparsed
+# returns the list of byte payloads and the list of their sizes in bytes
+def serialize_records(data, record_format='json'):
+    if data.shape[0] == 0:
+        return [], []
+    if record_format == 'json':
+        # json escapes newlines inside values, so every line of the output is exactly one record
+        payloads = data.to_json(orient='records', lines=True).encode('utf-8').split(b'\n')
+        if payloads[-1] == b'':
+            payloads.pop()
+    elif record_format == 'pipe':
+        values = data.astype(object).where(data.notna(), '')
+        columns = [values[column].astype(str) for column in values.columns]
+        lines = columns[0].str.cat(columns[1:], sep='|') if len(columns) > 1 else columns[0]
+        payloads = lines.str.encode('utf-8').tolist()
+    elif record_format == 'raw':
+        payloads = data.iloc[:, 0].tolist()
+    else:
+        raise ValueError("unknown record format {}, supported formats are {}".format(record_format, RECORD_FORMATS))
+    sizes = [len(payload) for payload in payloads]
+    return payloads, sizes
+
+
+# number of open shards of the stream, cached for SHARD_COUNT_TTL seconds as describe_stream_summary
+# is limited to a few calls per second per account. returns None when the stream can't be described
+def get_shard_count(kinesis_client, stream_name):
+    cached = _shard_counts.get(stream_name)
+    if cached is not None and time.monotonic() - cached[1] < SHARD_COUNT_TTL:
+        return cached[0]
+    try:
+        response = kinesis_client.describe_stream_summary(StreamName=stream_name)
+    except ClientError as e:
+        logging.warning("Unable to describe stream {}, error message:{}".format(stream_name,
+                                                                                e.response['Error']['Message']))
+        return None
+    shard_count = response['StreamDescriptionSummary']['OpenShardCount']
+    _shard_counts[stream_name] = (shard_count, time.monotonic())
+    return shard_count
+
+
+# (starting, ending) hash keys of the open shards of the stream sorted by starting hash key,
+# cached for SHARD_COUNT_TTL seconds. returns an empty list when the shards can't be listed
+def get_shard_hash_ranges(kinesis_client, stream_name):
+    cached = _shard_hash_ranges.get(stream_name)
+    if cached is not None and time.monotonic() - cached[1] < SHARD_COUNT_TTL:
+        return cached[0]
+    hash_ranges = []
+    request = {'StreamName': stream_name}
+    try:
+        while True:
+            response = kinesis_client.list_shards(**request)
+            for shard in response['Shards']:
+                if 'EndingSequenceNumber' in shard.get('SequenceNumberRange', {}):
+                    continue  # closed by a reshard, can't be written to
+                hash_ranges.append((int(shard['HashKeyRange']['StartingHashKey']),
+                                    int(shard['HashKeyRange']['EndingHashKey'])))
+            if not response.get('NextToken'):
+                break
+            request = {'NextToken': response['NextToken']}
+    except ClientError as e:
+        logging.warning("Unable to list shards of stream {}, error message:{}".format(stream_name,
+                                                                                      e.response['Error']['Message']))
+        return []
+    hash_ranges.sort()
+    _shard_hash_ranges[stream_name] = (hash_ranges, time.monotonic())
+    return hash_ranges
+
+
+# one explicit hash key per open shard of the stream, the middle of the hash key range of the shard
+def get_shard_hash_keys(kinesis_client, stream_name):
+    return [str((starting_hash_key + ending_hash_key) // 2)
+            for (starting_hash_key, ending_hash_key) in get_shard_hash_ranges(kinesis_client, stream_name)]
+
+
+# partition keys of the rows of a dataframe for one of PARTITION_KEY_STRATEGIES. the hash strategy
+# uses the index as partition key, the shard is picked by the keys of get_explicit_hash_keys
+def get_partition_keys(data, strategy='index', column=None):
+    index_keys = data.index.astype(str).tolist()
+    if strategy in ('index', 'hash'):
+        return index_keys
+    if strategy == 'column':
+        if column not in data.columns:
+            raise ValueError("partition key column {} is not in the dataset".format(column))
+        values = data[column]
+        keys = values.astype(object).where(values.notna(), '').astype(str).str.slice(0, MAX_PARTITION_KEY_LENGTH)
+        # kinesis needs a non empty key, rows without a value fall back to their index
+        return [key if key else index_key for (key, index_key) in zip(keys.tolist(), index_keys)]
+    if strategy == 'random':
+        return ['%016x' % random.getrandbits(64) for _ in range(data.shape[0])]
+    raise ValueError("unknown partition key strategy {}, supported strategies are {}".format(
+        strategy, PARTITION_KEY_STRATEGIES))
+
+
+# explicit hash keys for record_count records, dealt round robin over the shards starting at a
+# random shard so small batches don't always land on the first shard
+def get_explicit_hash_keys(kinesis_client, stream_name, record_count):
+    hash_keys = get_shard_hash_keys(kinesis_client, stream_name)
+    if not hash_keys:
+        return None
+    start = random.randrange(len(hash_keys))
+    return [hash_keys[(start + position) % len(hash_keys)] for position in range(record_count)]
+
+
+# records and bytes packed into one put_records request, the api limits capped by what the
+# shards of the stream can take in one second so a single request never overruns the stream
+def get_batch_limits(shard_count=None):
+    if not shard_count:
+        return MAX_RECORDS_PER_REQUEST, MAX_BYTES_PER_REQUEST
+    return (min(MAX_RECORDS_PER_REQUEST, shard_count * SHARD_RECORDS_PER_SEC),
+            min(MAX_BYTES_PER_REQUEST, shard_count * SHARD_BYTES_PER_SEC))
+
+
+# packs serialized records into put_records batches that respect the per request record and byte
+# limits, counting the partition key toward the size. yields the records of a batch and its size in
+# bytes, a single record over MAX_BYTES_PER_RECORD raises ValueError as kinesis would reject it.
+# explicit_hash_keys, when given, pins every record to a shard
+def pack_batches(payloads, sizes, partition_keys, max_records=MAX_RECORDS_PER_REQUEST,
+                 max_bytes=MAX_BYTES_PER_REQUEST, explicit_hash_keys=None):
+    records = []
+    batch_bytes = 0
+    for position in range(len(payloads)):
+        partition_key = partition_keys[position]
+        record_bytes = sizes[position] + len(partition_key.encode('utf-8'))
+        if record_bytes > MAX_BYTES_PER_RECORD:
+            raise ValueError("record {} with partition key {} is {} bytes, above the kinesis limit of {}".format(
+                position, partition_key, record_bytes, MAX_BYTES_PER_RECORD))
+        if records and (len(records) == max_records or batch_bytes + record_bytes > max_bytes):
+            yield records, batch_bytes
+            records = []
+            batch_bytes = 0
+        record = {"Data": payloads[position], "PartitionKey": partition_key}
+        if explicit_hash_keys is not None:
+            record["ExplicitHashKey"] = explicit_hash_keys[position]
+        records.append(record)
+        batch_bytes = batch_bytes + record_bytes
+    if records:
+        yield records, batch_bytes
+
+
+# paces put_records requests to a records and bytes per second budget, e.g. a share of the
+# shard limits, allowing up to one second of burst. wait() may be called from several threads,
+# each call reserves its slot under the lock and sleeps outside of it
+class ThroughputLimiter:
+    def __init__(self, records_per_sec, bytes_per_sec):
+        self.records_per_sec = float(records_per_sec)
+        self.bytes_per_sec = float(bytes_per_sec)
+        self.available_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<%s records_per_sec=%r bytes_per_sec=%r>" % (type(self).__name__, self.records_per_sec,
+                                                               self.bytes_per_sec)
+
+    # budget for a stream with shard_count shards, each allowed shard_mb_per_sec MB/s
+    @classmethod
+    def for_shards(cls, shard_count, shard_mb_per_sec):
+        share = min(float(shard_mb_per_sec) * 1024 * 1024, SHARD_BYTES_PER_SEC) / SHARD_BYTES_PER_SEC
+        return cls(shard_count * SHARD_RECORDS_PER_SEC * share, shard_count * SHARD_BYTES_PER_SEC * share)
+
+    def wait(self, record_count, byte_count):
+        with self.lock:
+            now = time.monotonic()
+            self.available_at = max(self.available_at, now - 1.0)
+            start_at = self.available_at
+            self.available_at = self.available_at + max(record_count / self.records_per_sec,
+                                                        byte_count / self.bytes_per_sec)
+        if start_at > now:
+            time.sleep(start_at - now)
+
+
+# the ThroughputLimiter of a stream, shared by all the calls and threads sending to it in this process
+# so the budget holds across chunks and files instead of starting over with every send. a new shard
+# count or share replaces the limiter, keeping the time its budget is spent until
+def get_throughput_limiter(stream_name, shard_count, shard_mb_per_sec):
+    with _limiters_lock:
+        cached = _limiters.get(stream_name)
+        if cached is not None and cached[0] == (shard_count, shard_mb_per_sec):
+            return cached[1]
+        limiter = ThroughputLimiter.for_shards(shard_count, shard_mb_per_sec)
+        if cached is not None:
+            limiter.available_at = cached[1].available_at
+        _limiters[stream_name] = ((shard_count, shard_mb_per_sec), limiter)
+        return limiter
+
+
+# exponential backoff with full jitter, the ceiling grows with the share of throttled records
+# so a batch that was mostly throttled backs off harder than one with a few internal failures
+def backoff_delay(attempt, throttle_rate, base_delay=BASE_RETRY_DELAY, max_delay=MAX_RETRY_DELAY):
+    ceiling = min(max_delay, base_delay * (2 ** attempt) * (0.5 + throttle_rate))
+    return random.uniform(0, ceiling)
+
+
+# puts a batch to kinesis and re-submits only the entries reported as failed in the response,
+# backing off between attempts. a retryable error of the whole call re-submits the whole batch,
+# any other error is raised. returns the number of delivered, retried (re-submitted) and
+# dropped records (still failing after max_attempts)
+def put_records_with_retry(kinesis_client, stream_name, records, max_attempts=MAX_PUT_ATTEMPTS,
+                           base_delay=BASE_RETRY_DELAY, max_delay=MAX_RETRY_DELAY):
+    counts = {'delivered': 0, 'retried': 0, 'dropped': 0}
+    attempt = 0
+    while records:
+        try:
+            response = kinesis_client.put_records(Records=records, StreamName=stream_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in RETRYABLE_ERROR_CODES or attempt + 1 >= max_attempts:
+                raise
+            failed_records = records
+            throttle_rate = 1.0 if e.response['Error']['Code'] in THROTTLE_ERROR_CODES else 0.0
+        else:
+            failed_records = []
+            throttled = 0
+            if response.get('FailedRecordCount', 0) > 0:
+                for record, result in zip(records, response['Records']):
+                    if 'ErrorCode' in result:
+                        failed_records.append(record)
+                        if result['ErrorCode'] in THROTTLE_ERROR_CODES:
+                            throttled = throttled + 1
+            counts['delivered'] = counts['delivered'] + len(records) - len(failed_records)
+            throttle_rate = throttled / len(records)
+            if failed_records and attempt + 1 >= max_attempts:
+                counts['dropped'] = len(failed_records)
+                break
+        if failed_records:
+            attempt = attempt + 1
+            counts['retried'] = counts['retried'] + len(failed_records)
+            time.sleep(backoff_delay(attempt, throttle_rate, base_delay, max_delay))
+        records = failed_records
+    return counts
+
+
+# keeps several put_records calls in flight over a thread pool (boto3 clients are thread safe)
+# so a single process can drive all shards of a stream.
+#   max_in_flight - number of concurrent put_records calls
+#   max_queued    - number of batches submitted but not yet completed, submit() blocks on the
+#                   oldest batch once it is reached, which bounds memory (backpressure)
+#   max_attempts  - attempts per batch, failed entries are re-submitted by put_records_with_retry
+#   limiter       - optional ThroughputLimiter pacing the batches to a throughput budget
+# batches are completed in submission order, so sent_records always counts a prefix of the
+# records handed to submit(). errors from put_records are raised by submit() or flush().
+class PutRecordsPipeline:
+    def __init__(self, kinesis_client, stream_name, max_in_flight=1, max_queued=None, max_attempts=MAX_PUT_ATTEMPTS,
+                 limiter=None):
+        self.kinesis_client = kinesis_client
+        self.stream_name = stream_name
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.max_queued = max(self.max_in_flight, int(max_queued or 2 * self.max_in_flight))
+        self.max_attempts = max(1, int(max_attempts))
+        self.limiter = limiter
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        self.pending = deque()
+        self.sent_batches = 0
+        self.sent_records = 0
+        self.sent_bytes = 0
+        self.delivered_records = 0
+        self.retried_records = 0
+        self.dropped_records = 0
+
+    def __repr__(self):
+        return "<%s stream_name=%r max_in_flight=%d>" % (type(self).__name__, self.stream_name, self.max_in_flight)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel=exc_type is not None)
+
+    def submit(self, records, batch_bytes=0):
+        while len(self.pending) >= self.max_queued:
+            self._complete_oldest()
+        if self.limiter is not None:
+            self.limiter.wait(len(records), batch_bytes)
+        future = self.executor.submit(put_records_with_retry, self.kinesis_client, self.stream_name, records,
+                                      self.max_attempts)
+        self.pending.append((future, len(records), batch_bytes))
+
+    def _complete_oldest(self):
+        (future, record_count, batch_bytes) = self.pending.popleft()
+        counts = future.result()
+        self.sent_batches = self.sent_batches + 1
+        self.sent_records = self.sent_records + record_count
+        self.sent_bytes = self.sent_bytes + batch_bytes
+        self.delivered_records = self.delivered_records + counts['delivered']
+        self.retried_records = self.retried_records + counts['retried']
+        self.dropped_records = self.dropped_records + counts['dropped']
+        return counts
+
+    # bytes and delivered/retried/dropped record counts of everything completed so far
+    def counters(self):
+        return {'sent_bytes': self.sent_bytes, 'delivered_records': self.delivered_records,
+                'retried_records': self.retried_records, 'dropped_records': self.dropped_records}
+
+    def flush(self):
+        while self.pending:
+            self._complete_oldest()
+
+    def close(self, cancel=False):
+        if not cancel:
+            self.flush()
+        self.pending.clear()
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
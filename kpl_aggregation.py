@@ -0,0 +1,226 @@
+# KPL compatible record aggregation and de-aggregation
+# many small user records are packed into one kinesis record so a shard is limited by its 1 MB/s
+# rather than its 1000 records/s. the layout is the one of the kinesis producer library, so KCL
+# consumers and lambda de-aggregation libraries can read the records:
+#   magic header (f3 89 9a c2) + protobuf AggregatedRecord + md5 of the protobuf
+# message AggregatedRecord {
+#     repeated string partition_key_table = 1;
+#     repeated string explicit_hash_key_table = 2;
+#     repeated Record records = 3;
+# }
+# message Record {
+#     required uint64 partition_key_index = 1;
+#     optional uint64 explicit_hash_key_index = 2;
+#     required bytes data = 3;
+# }
+import bisect
+import hashlib
+
+KPL_MAGIC = b'\xf3\x89\x9a\xc2'
+# default size of an aggregated record, same as the kinesis producer library
+MAX_AGGREGATED_BYTES = 51200
+
+# protobuf wire types
+_WIRE_VARINT = 0
+_WIRE_LENGTH_DELIMITED = 2
+_DIGEST_SIZE = 16
+
+
+def _encode_varint(value):
+    encoded = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(bits | 0x80)
+        else:
+            encoded.append(bits)
+            return bytes(encoded)
+
+
+def _decode_varint(buffer, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position = position + 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift = shift + 7
+
+
+def _encode_tag(field_number, wire_type):
+    return _encode_varint((field_number << 3) | wire_type)
+
+
+def _encode_bytes_field(field_number, value):
+    return _encode_tag(field_number, _WIRE_LENGTH_DELIMITED) + _encode_varint(len(value)) + value
+
+
+def _encode_varint_field(field_number, value):
+    return _encode_tag(field_number, _WIRE_VARINT) + _encode_varint(value)
+
+
+# the hash key kinesis computes for a partition key, used to find the shard a record maps to
+def partition_key_hash(partition_key):
+    return int.from_bytes(hashlib.md5(partition_key.encode('utf-8')).digest(), 'big')
+
+
+# collects user records for one aggregated kinesis record
+class RecordAggregator:
+    def __init__(self, max_bytes=MAX_AGGREGATED_BYTES):
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def __repr__(self):
+        return "<%s records=%d size=%d>" % (type(self).__name__, self.record_count, self.size)
+
+    def __len__(self):
+        return self.record_count
+
+    def clear(self):
+        self.partition_keys = {}
+        self.explicit_hash_keys = {}
+        self.body = []
+        self.record_count = 0
+        self.size = len(KPL_MAGIC) + _DIGEST_SIZE
+        self.first_partition_key = None
+
+    # encoded size the aggregated record would grow by when adding the user record
+    def _added_size(self, partition_key, explicit_hash_key, data):
+        record_size = 2 + len(_encode_varint(len(self.partition_keys))) + len(_encode_varint(len(data))) + len(data)
+        added = 0
+        if partition_key not in self.partition_keys:
+            key_bytes = len(partition_key.encode('utf-8'))
+            added = added + 1 + len(_encode_varint(key_bytes)) + key_bytes
+        if explicit_hash_key is not None:
+            record_size = record_size + 1 + len(_encode_varint(len(self.explicit_hash_keys)))
+            if explicit_hash_key not in self.explicit_hash_keys:
+                added = added + 1 + len(_encode_varint(len(explicit_hash_key))) + len(explicit_hash_key)
+        return added + 1 + len(_encode_varint(record_size)) + record_size
+
+    # adds a user record, returns False without adding it when the aggregated record would
+    # grow above max_bytes (a lone record is always accepted)
+    def add(self, partition_key, data, explicit_hash_key=None):
+        added = self._added_size(partition_key, explicit_hash_key, data)
+        if self.record_count and self.size + added > self.max_bytes:
+            return False
+        if self.first_partition_key is None:
+            self.first_partition_key = partition_key
+        partition_key_index = self.partition_keys.setdefault(partition_key, len(self.partition_keys))
+        record = _encode_varint_field(1, partition_key_index)
+        if explicit_hash_key is not None:
+            explicit_hash_key_index = self.explicit_hash_keys.setdefault(explicit_hash_key,
+                                                                         len(self.explicit_hash_keys))
+            record = record + _encode_varint_field(2, explicit_hash_key_index)
+        record = record + _encode_bytes_field(3, data)
+        self.body.append(_encode_bytes_field(3, record))
+        self.record_count = self.record_count + 1
+        self.size = self.size + added
+        return True
+
+    # the kinesis Data of the aggregated record
+    def serialize(self):
+        message = b''.join([_encode_bytes_field(1, key.encode('utf-8')) for key in self.partition_keys] +
+                           [_encode_bytes_field(2, key.encode('utf-8')) for key in self.explicit_hash_keys] +
+                           self.body)
+        return KPL_MAGIC + message + hashlib.md5(message).digest()
+
+
+# aggregates serialized user records into KPL aggregated records of at most max_bytes.
+# user records are grouped by the shard their partition key (or explicit hash key) maps to and the
+# aggregated record is pinned to that shard with an explicit hash key, so the records of a
+# partition key still land on one shard, in their original order within an aggregated record (across
+# aggregated records the order is that of their delivery, see put_records_with_retry). without shard
+# hash ranges the records are grouped by partition key.
+# returns the payloads, sizes, partition keys and explicit hash keys of the aggregated records
+def aggregate_records(payloads, partition_keys, shard_hash_ranges=None, explicit_hash_keys=None,
+                      max_bytes=MAX_AGGREGATED_BYTES):
+    starting_hash_keys = [starting_hash_key for (starting_hash_key, _) in shard_hash_ranges or []]
+    aggregators = {}
+    aggregated = []
+
+    def emit(group, aggregator):
+        if shard_hash_ranges:
+            (starting_hash_key, ending_hash_key) = shard_hash_ranges[group]
+            explicit_hash_key = str((starting_hash_key + ending_hash_key) // 2)
+        else:
+            explicit_hash_key = None
+        aggregated.append((aggregator.serialize(), aggregator.first_partition_key, explicit_hash_key))
+        aggregator.clear()
+
+    for position in range(len(payloads)):
+        partition_key = partition_keys[position]
+        explicit_hash_key = explicit_hash_keys[position] if explicit_hash_keys is not None else None
+        if starting_hash_keys:
+            hash_key = int(explicit_hash_key) if explicit_hash_key is not None else partition_key_hash(partition_key)
+            group = max(0, bisect.bisect_right(starting_hash_keys, hash_key) - 1)
+        else:
+            group = partition_key
+        aggregator = aggregators.get(group)
+        if aggregator is None:
+            aggregator = aggregators[group] = RecordAggregator(max_bytes)
+        if not aggregator.add(partition_key, payloads[position], explicit_hash_key):
+            emit(group, aggregator)
+            aggregator.add(partition_key, payloads[position], explicit_hash_key)
+    for (group, aggregator) in aggregators.items():
+        if len(aggregator):
+            emit(group, aggregator)
+
+    aggregated_payloads = [payload for (payload, _, _) in aggregated]
+    aggregated_sizes = [len(payload) for payload in aggregated_payloads]
+    aggregated_partition_keys = [partition_key for (_, partition_key, _) in aggregated]
+    aggregated_explicit_hash_keys = None
+    if shard_hash_ranges:
+        aggregated_explicit_hash_keys = [explicit_hash_key for (_, _, explicit_hash_key) in aggregated]
+    return aggregated_payloads, aggregated_sizes, aggregated_partition_keys, aggregated_explicit_hash_keys
+
+
+# splits a kinesis record back into its user records as (partition_key, explicit_hash_key, data) tuples.
+# records that are not KPL aggregated (or fail the md5 check) are returned as a single user record
+# with the given partition key
+def deaggregate_record(data, partition_key=None):
+    data = bytes(data)
+    if len(data) < len(KPL_MAGIC) + _DIGEST_SIZE or not data.startswith(KPL_MAGIC):
+        return [(partition_key, None, data)]
+    message = data[len(KPL_MAGIC):-_DIGEST_SIZE]
+    if hashlib.md5(message).digest() != data[-_DIGEST_SIZE:]:
+        return [(partition_key, None, data)]
+
+    partition_key_table = []
+    explicit_hash_key_table = []
+    records = []
+    for (field_number, value) in _iter_fields(message):
+        if field_number == 1:
+            partition_key_table.append(value.decode('utf-8'))
+        elif field_number == 2:
+            explicit_hash_key_table.append(value.decode('utf-8'))
+        elif field_number == 3:
+            records.append(value)
+
+    user_records = []
+    for record in records:
+        fields = dict(_iter_fields(record))
+        explicit_hash_key = None
+        if 2 in fields:
+            explicit_hash_key = explicit_hash_key_table[fields[2]]
+        user_records.append((partition_key_table[fields[1]], explicit_hash_key, fields.get(3, b'')))
+    return user_records
+
+
+# yields (field_number, value) of a protobuf message, value is an int for varints and bytes otherwise
+def _iter_fields(message):
+    position = 0
+    while position < len(message):
+        (tag, position) = _decode_varint(message, position)
+        (field_number, wire_type) = (tag >> 3, tag & 0x7)
+        if wire_type == _WIRE_VARINT:
+            (value, position) = _decode_varint(message, position)
+        elif wire_type == _WIRE_LENGTH_DELIMITED:
+            (length, position) = _decode_varint(message, position)
+            value = message[position:position + length]
+            position = position + length
+        else:
+            raise ValueError("unsupported protobuf wire type {}".format(wire_type))
+        yield field_number, value
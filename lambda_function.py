@@ -1,14 +1,18 @@
+import time
+# seconds the modules of the handler take to import, the bulk of a cold start. logged by the first
+# invocation of a container, pandas is only imported once a file is parsed (see s3_to_kinesis.py)
+_import_started = time.perf_counter()
+import boto3
 import json
 import logging
 import os
 import re
-import boto3
-from botocore.exceptions import ClientError
-import datetime
-import pandas as pd
-import argparse
-import io
-import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from s3_to_kinesis import run_process, connect_dynamo_tbl, prefetch_configs, get_s3_location_path, FileHandedOff, \
+    FileInProgress
+from metastore import MetastoreWriter
+IMPORT_SECONDS = time.perf_counter() - _import_started
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -16,330 +20,161 @@ logger.setLevel(logging.INFO)
 config_table = os.getenv("db_config_table")
 meta_table = os.getenv("db_metastore_table")
 file_prefix = os.getenv("file_prefix")
-
-
-dynamo = boto3.resource('dynamodb')
-s3 = boto3.resource('s3')
-kinesis = boto3.client('kinesis')
-
-## recommended to move to a separate file
-class S3File(io.RawIOBase):
-    def __init__(self, s3_object):
-        self.s3_object = s3_object
-        self.position = 0
-
-    def __repr__(self):
-        return "<%s s3_object=%r>" % (type(self).__name__, self.s3_object)
-
-    @property
-    def size(self):
-        return self.s3_object.content_length
-
-    def tell(self):
-        return self.position
-
-    def seek(self, offset, whence=io.SEEK_SET):
-        if whence == io.SEEK_SET:
-            self.position = offset
-        elif whence == io.SEEK_CUR:
-            self.position += offset
-        elif whence == io.SEEK_END:
-            self.position = self.size + offset
-        else:
-            raise ValueError("invalid whence (%r, should be %d, %d, %d)" % (
-                whence, io.SEEK_SET, io.SEEK_CUR, io.SEEK_END
-            ))
-
-        return self.position
-
-    def seekable(self):
-        return True
-
-    def read(self, size=-1):
-        if size == -1:
-            # Read to the end of the file
-            range_header = "bytes=%d-" % self.position
-            self.seek(offset=0, whence=io.SEEK_END)
+# "true" keeps the metastore writes of an invocation in memory and writes them with batch_write_item at the end
+buffer_metastore_writes = os.getenv("buffer_metastore_writes", "false").lower() == "true"
+# files of an invocation processed at a time, bounded by the memory of the function: every file in flight
+# is given memory_per_file_mb
+file_workers = int(os.getenv("file_workers", "4"))
+memory_per_file_mb = int(os.getenv("memory_per_file_mb", "512"))
+# a file is not started with less time left in the invocation, it is reported as failed and retried
+min_file_time_ms = int(os.getenv("min_file_time_ms", "30000"))
+# a file still being sent handoff_margin_ms before the invocation times out is stopped, its checkpoint is
+# recorded in the metastore and the file is queued on handoff_queue_name (the queue of sqs_to_process.py)
+# for the EC2 workers to send the rest. without a queue the file fails and its retry resumes from there
+handoff_queue_name = os.getenv("handoff_queue_name")
+handoff_margin_ms = int(os.getenv("handoff_margin_ms", "20000"))
+
+# file names are matched against the prefix once per record, compiled once per container
+file_prefix_pattern = re.compile(file_prefix) if file_prefix else None
+service_type = "lambda"
+# created when the first file is handed off
+sqs = None
+_handoff_queue_url = None
+_sqs_lock = threading.Lock()
+cold_start = True
+
+
+# the s3 files of an event as (item identifier, s3 file path, etag), for s3 notifications delivered
+# straight to the function or through an sqs queue (one s3 notification per message), the item
+# identifier of a file is the id of its sqs message or its s3 file path.
+# files whose name does not match file_prefix are left out
+def get_event_files(event):
+    files = []
+    for record in event.get('Records', []):
+        if 'body' in record:
+            # s3:TestEvent messages carry no records
+            s3_records = json.loads(record['body']).get('Records', [])
+            item_id = record['messageId']
         else:
-            new_position = self.position + size
-
-            # If we're going to read beyond the end of the object, return
-            # the entire object.
-            if new_position >= self.size:
-                return self.read()
-
-            range_header = "bytes=%d-%d" % (self.position, new_position - 1)
-            self.seek(offset=size, whence=io.SEEK_CUR)
-
-        return self.s3_object.get(Range=range_header)["Body"].read()
-
-    def readable(self):
-        return True
-
-
-# function for sending data to Kinesis at the absolute maximum throughput
-# depending on shard size, we need to change the value/size we want to send  to
-# kinesis, here we used 9500 0r 800000bytes for 10 shards (10000 records or 10MB )
-# recommended : put it in separate file and call from here
-# the number of reocrds and bytes should be reflected by shard number of kinesis
-def send_to_kinesis(kinesis_stream_name, data):
-    kinesis_records = []  # empty list to store data
-    (rows, columns) = data.shape  # get rows and columns off provided data
-    current_bytes = 0  # counter for bytes
-    row_count = 0  # as we start with the first
-    total_row_count = rows  # using our rows variable we got earlier
-    send_kinesis = False  # flag to update when it's time to send data
-
-    for i in data.index:
-        value = data.loc[i].to_json()
-        encoded_values = bytes(value, 'utf-8')  # encode the string to bytes
-        # create a dict object of the row
-        kinesis_record = {
-            "Data": encoded_values,  # data byte-encoded
-            "PartitionKey": str(i)  # some key used to tell Kinesis which shard to use
-        }
-        kinesis_records.append(kinesis_record)  # add the object to the list
-        string_bytes = len(value.encode('utf-8'))  # get the number of bytes from the string
-        current_bytes = current_bytes + string_bytes  # keep a running total
-        # check conditional whether ready to send
-        if len(kinesis_records) == 9500:  # if we have 500 records packed up, then proceed
-            send_kinesis = True  # set the flag
-        if current_bytes > 800000:  # if the byte size is over 50000, proceed
-            send_kinesis = True  # set the flag
-        if row_count == total_row_count - 1:  # if we've reached the last record in the results
-            send_kinesis = True  # set the flag
-        # if the flag is set
-        if send_kinesis:
-            # put the records to kinesis
-            try:
-                response = kinesis.put_records(
-                    Records=kinesis_records,
-                    StreamName=kinesis_stream_name
-                )
-            except ClientError as e:
-                logging.error(
-                    "Error while trying to send data to {}, error message:{}".format(kinesis_stream_name,
-                                                                                     e.response['Error']['Message']))
-                return None
-
-            # resetting values ready for next loop
-            kinesis_records = []  # empty array
-            send_kinesis = False  # reset flag
-            current_bytes = 0  # reset bytecount
-        # regardless, make sure to incrememnt the counter for rows.
-        row_count = row_count + 1
-    # log out how many records were pushed
-    logging.info('Total Records sent to Kinesis: {0}'.format(total_row_count))
-    return "OK"
-
-
-def connect_dynamo_tbl(tbl_name):
-    if not dynamo:
-        boto3.resource('dynamodb')
-    return dynamo.Table(tbl_name)
-
-
-def read_dynamo_tbl_item(tbl, key):
+            s3_records = [record]
+            item_id = None
+        for s3_record in s3_records:
+            filekey = s3_record['s3']['object']['key']
+            bucket = s3_record['s3']['bucket']['name']
+            filename_only = filekey[filekey.rfind("/")+1:]
+            if file_prefix_pattern is not None and not file_prefix_pattern.search(filename_only):
+                logger.info("file {} does not have required prefix {}, ignoring the file.".format(filename_only,
+                                                                                                  file_prefix))
+                continue
+            s3_file_path = "s3://"+bucket+"/"+filekey
+            # the etag of the event claims the file, a redelivered notification of a sent file is skipped
+            files.append((item_id or s3_file_path, s3_file_path, s3_record['s3']['object'].get('eTag')))
+    return files
+
+
+# number of files processed at a time, within the memory of the invocation
+def get_file_workers(context, file_count):
+    workers = file_workers
+    memory_limit_mb = getattr(context, 'memory_limit_in_mb', None)
+    if memory_limit_mb:
+        workers = min(workers, int(memory_limit_mb) // memory_per_file_mb)
+    return max(1, min(workers, file_count))
+
+
+def get_sqs():
+    global sqs
+    if sqs is None:
+        with _sqs_lock:
+            if sqs is None:
+                sqs = boto3.client("sqs")
+    return sqs
+
+
+def get_handoff_queue_url():
+    global _handoff_queue_url
+    if _handoff_queue_url is None:
+        _handoff_queue_url = get_sqs().get_queue_url(QueueName=handoff_queue_name)['QueueUrl']
+    return _handoff_queue_url
+
+
+# queues the rest of a file that ran out of time for sqs_to_process.py, the status of the file with its
+# checkpoint has to be in the metastore before a worker picks the message up and claims the file
+def hand_off_file(s3_file_path, metadata_writer):
+    metadata_writer.flush(finished_only=True)
+    get_sqs().send_message(QueueUrl=get_handoff_queue_url(), MessageBody=s3_file_path)
+    logger.info("queued the rest of {} on {}".format(s3_file_path, handoff_queue_name))
+
+
+# runs in a thread of the handler, run_process exits on failure so that is turned into a return value.
+# a file that ran out of time counts as processed once the rest of it is queued
+def process_file(context, s3_file_path, etag, dynamo_config, metadata_writer):
+    deadline = None
+    if context is not None:
+        remaining_ms = context.get_remaining_time_in_millis()
+        if remaining_ms < min_file_time_ms:
+            logger.error("not enough time left to process {}, leaving it to a retry".format(s3_file_path))
+            return False
+        deadline = time.monotonic() + (remaining_ms - handoff_margin_ms) / 1000.0
+    logger.info("start processing {}".format(s3_file_path))
     try:
-        response = tbl.get_item(Key=key)
-    except ClientError as e:
-        raise Exception(
-            "Error while trying to read from {}, error message:{}".format(tbl, e.response['Error']['Message']))
-    else:
-        if "Item" in response:
-            return 200, (response['Item'])
-        else:
-            return 0, "record not found in table with key {}".format(key)
-
-
-def read_config_dynamo(config_tbl_name, service_name, s3path):
-    config_tbl = connect_dynamo_tbl(config_tbl_name)
-    return read_dynamo_tbl_item(config_tbl, {'service_pk': service_name, 's3_location_path': s3path})
-
-
-def item_exist(metadata_tbl, file_name):
-    (status, response) = read_dynamo_tbl_item(metadata_tbl, {'file_name': file_name})
-    if status != 200:
+        if not run_process(config_table, meta_table, service_type, s3_file_path, dynamo_config=dynamo_config,
+                           metadata_writer=metadata_writer, etag=etag, deadline=deadline):
+            logger.info("skipped duplicate notification of {}".format(s3_file_path))
+    except FileInProgress as e:
+        # the other attempt may still fail, the file is reported as failed to be retried
+        logger.info("{}, leaving it to a retry".format(e))
+        return False
+    except FileHandedOff as e:
+        if not handoff_queue_name:
+            logger.error("{}, no handoff_queue_name to queue the rest on".format(e))
+            return False
+        try:
+            hand_off_file(s3_file_path, metadata_writer)
+        except Exception as e:
+            logger.error("Unable to queue the rest of {}: {!r}".format(s3_file_path, e))
+            return False
+    except (Exception, SystemExit) as e:
+        logger.error("Processing of {} failed: {!r}".format(s3_file_path, e))
         return False
     return True
 
-# updates dynamo db metastore status based on lifecycle of the process
-# such as reading file, converted to datafame, send to kinesis or failed status
-def update_file(metadata_writer, status, file_name, file_format, dest_kds, reason="ok"):
-    if status == 'reading_file':
-        if item_exist(metadata_writer, file_name):
-            response = metadata_writer.update_item(
-                Key={
-                    'file_name': file_name
-                },
-                UpdateExpression="set p_status=:s, updated_timestamp=:uts, reason=:r, create_timestamp=:cts",
-                ExpressionAttributeValues={
-                    ':s': status,
-                    ':uts': datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S"),
-                    ':r': '',
-                    ':cts': datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-                },
-                ReturnValues="UPDATED_NEW"
-            )
-        else:
-            response = metadata_writer.put_item(
-                Item={
-                    'file_name': file_name,
-                    'p_status': status,
-                    'file_format': file_format,
-                    'dest_kds': dest_kds,
-                    'create_timestamp': datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-                }
-            )
-    elif status in ['read_and_converted_to_df', 'processed_and_sent_to_kds', 'failed_at_file_read',
-                    'failed_at_kinesis']:
-        response = metadata_writer.update_item(
-            Key={
-                'file_name': file_name
-            },
-            UpdateExpression="set p_status=:s, updated_timestamp=:uts, reason=:r",
-            ExpressionAttributeValues={
-                ':s': status,
-                ':uts': datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S"),
-                ':r': reason
-            },
-            ReturnValues="UPDATED_NEW"
-        )
-    return response
-
-
-def get_file_separator(file_format):
-    if file_format == 'comma':
-        sep = ','
-    elif file_format == 'tab':
-        sep = '\t'
-    elif file_format == 'space':
-        sep = '\s+'
-    elif file_format == 'pipe':
-        sep = '|'
-    else:
-        sep = None
-    return sep
-
-
-def check_file_root(file_path):
-    return file_path.split("://")[0]
 
-# reads s3 file - regular, zip or gzip
-def read_s3_file(file_path, is_file_zipped, sep, header):
-    (bucket, file_key) = parse_s3_file_path(file_path)
-    obj = s3.Object(bucket, file_key)
-    if not is_file_zipped:
-        body = obj.get()['Body']
-        dataframe = pd.read_csv(body, sep=sep, header=header, low_memory=False)
-    else:
-        if ".gz" in file_key:
-            body = obj.get()['Body']
-            dataframe = pd.read_csv(body, sep=sep, compression='gzip', header=header)
-        elif ".zip" in file_key:
-            s3_file = S3File(obj)
-            with zipfile.ZipFile(s3_file) as zf:
-                for file in zf.namelist():
-                    with zf.open(file) as content:
-                        dataframe = pd.read_csv(content, sep=sep, header=header, low_memory=False)
-    return dataframe
-
-# reads file with defined configuration - header_exists, file_format, file_path, is_file_zipped, column_names
-# it can read file from s3 or local/NAS  path. based on parsing file_path it
-# figures out whether file is in s3. The method can read comma, tab, space, pipe separated format
-def read_file(file_format, header_exist, column_names, file_path, is_file_zipped):
-    header = 0 if header_exist else None
-    columns = [col.strip() for col in column_names.split(",")]
-    sep = get_file_separator(file_format)
+# reading, converting and sending the file is shared with s3_to_kinesis.py (packaged together
+# with this handler) so the lambda and the EC2 pumper stream files the same way.
+# the files of a batch of notifications are processed concurrently, their config items are read with
+# one batch_get_item. returns the failed files as a partial batch response: behind an sqs event source
+# mapping with ReportBatchItemFailures only their messages are retried. s3 notifications delivered
+# straight to the function are retried as a whole by raising, the files that were sent are skipped
+# as duplicates by their claim in the metastore. files still being sent close to the timeout of the
+# invocation are handed off to the EC2 workers (see handoff_queue_name)
+def lambda_handler(event, context):
+    global cold_start
+    if cold_start:
+        cold_start = False
+        logger.info("cold start, modules imported in {:.0f} ms".format(IMPORT_SECONDS * 1000))
+    files = get_event_files(event)
+    if not files:
+        return {'batchItemFailures': []}
     try:
-        if file_format in ('comma', 'tab', 'space', 'pipe'):
-            if check_file_root(file_path) == "s3":
-                dataframe = read_s3_file(file_path, is_file_zipped, sep, header)
-            else:
-                dataframe = pd.read_csv(file_path, sep=sep, header=header, low_memory=False)
-        else:
-            return 0, "unknown file format"
+        configs = prefetch_configs(config_table, service_type, [get_s3_location_path(s3_file_path)
+                                                                for (_, s3_file_path, _) in files])
     except Exception as e:
-        logging.error("Unable to parse file {} ".format(file_path))
-        return 0, "Unable to parse file {}".format(file_path)
-    if not header_exist:
-        if len(columns) != dataframe.shape[1]:
-            logging.info(
-                " Number of columns[{}] in the config table is {}, but the dataset had {} number of columns".format(
-                    column_names, len(columns), dataframe.shape[1]))
-            return (
-                0, " Number of columns[{}] in the config table is {}, but the dataset had {} number of columns".format(
-                    column_names, len(columns), dataframe.shape[1]))
-        else:
-            dataframe.columns = columns
-    dataframe_with_datatype = dataframe.convert_dtypes()
-    return 200, dataframe_with_datatype
-
-
-def parse_s3_file_path(s3_loc):
-    s3loc_array = s3_loc.split("//")[1]
-    index = s3loc_array.find("/")
-    bucket = s3loc_array[0:index]
-    s3_path = s3loc_array[index + 1:len(s3loc_array)]
-    return bucket, s3_path
+        logger.error("Unable to prefetch configs, the files read them one by one: {}".format(e))
+        configs = {}
 
-# starts the process, connects to dynamodb to read config and meta table
-# reads the file from s3 and writes to kinesis
-# keeps track of life cycle [reading file, writing to kinesis] in dynamodb meta table
-def run_process(config_table, meta_table, service_type, file_path):
-    (status, dynamo_config) = read_config_dynamo(config_table, service_type, file_path[0:file_path.rfind("/") + 1])
-    if status == 0:
-        raise Exception(dynamo_config)
-
-    logging.info(dynamo_config)
-    # read/write file status to dynamodb
-    metadata_writer = connect_dynamo_tbl(meta_table)
-
-    # insert loading status for file
-    logging.info("reading file ..")
-    update_file(metadata_writer, "reading_file", file_path, dynamo_config['source_data_format'],
-                dynamo_config['dest_kds_stream'])
-    # read s3 file
-    read_response = read_file(dynamo_config['source_data_format'], dynamo_config['header_exist'],
-                              dynamo_config['column_names'], file_path, dynamo_config['is_file_zipped'])
-
-    if read_response[0] == 200:
-        # update status of file to "read_and_converted_to_df"
-        update_file(metadata_writer, "read_and_converted_to_df", file_path, dynamo_config['source_data_format'],
-                    dynamo_config['dest_kds_stream'])
-        logging.info(" read file successfully & converted to dataframe.")
-    else:
-        # update status of file to "failed_at_file_read"
-        update_file(metadata_writer, "failed_at_file_read", file_path, dynamo_config['source_data_format'],
-                    dynamo_config['dest_kds_stream'], reason=read_response[1])
-        logging.info("failed at file reading {}".format(read_response[1]))
-        exit(1)
-    dataframe = read_response[1]
-    logging.info("started sending data to kinesis")
-    # send data to kinesis
-    response = send_to_kinesis(dynamo_config['dest_kds_stream'], dataframe)
-    if response is not None:
-        # update status of file to "processed_and_sent_to_kds"
-        update_file(metadata_writer, "processed_and_sent_to_kds", file_path, dynamo_config['source_data_format'],
-                    dynamo_config['dest_kds_stream'])
-    else:
-        # update status of file to "failed_at_kinesis"
-        update_file(metadata_writer, "failed_at_kinesis", file_path, dynamo_config['source_data_format'],
-                    dynamo_config['dest_kds_stream'], reason="error writing at kinesis")
-        logging.info("failed at kinesis")
-        exit(1)
-    logging.info("Process finished")
-
-def lambda_handler(event, context):
-    for record in event['Records']:
-        filekey = record['s3']['object']['key']
-        bucket = record['s3']['bucket']['name']
-        filename_only = filekey[filekey.rindex("/")+1 : len(filekey)]
-        if not re.search(file_prefix, filename_only):
-            logger.info("file {} does not have required prefix {}, ignoring the file.".format(filename_only, file_prefix))
-            break
-        s3_file_path = "s3://"+bucket+"/"+filekey
-        logger.info("s3 file path {}".format(s3_file_path))
-        logger.info("start processing")
-        service_type="lambda"
-        run_process(config_table, meta_table, service_type, s3_file_path)
+    metadata_writer = MetastoreWriter(connect_dynamo_tbl(meta_table), buffered=buffer_metastore_writes)
+    failed_items = []
+    try:
+        with ThreadPoolExecutor(max_workers=get_file_workers(context, len(files))) as executor:
+            futures = [executor.submit(process_file, context, s3_file_path, etag,
+                                       configs.get(get_s3_location_path(s3_file_path)), metadata_writer)
+                       for (_, s3_file_path, etag) in files]
+            for ((item_id, s3_file_path, _), future) in zip(files, futures):
+                if not future.result() and item_id not in failed_items:
+                    failed_items.append(item_id)
+    finally:
+        metadata_writer.flush()
+    logger.info("processed {} files, {} failed".format(len(files), len(failed_items)))
+    if any(record.get('eventSource') == 'aws:s3' for record in event['Records']) and failed_items:
+        raise Exception("failed to process {}".format(", ".join(failed_items)))
+    return {'batchItemFailures': [{'itemIdentifier': item_id} for item_id in failed_items]}
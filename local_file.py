@@ -0,0 +1,64 @@
+import io
+import mmap
+import os
+
+
+# memory maps a local/NAS file read only, None for an empty file (which can't be mapped)
+def map_file(file):
+    if os.fstat(file.fileno()).st_size == 0:
+        return None
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# splits a memory mapped file into at most `parts` byte ranges of about the same size that end at line
+# ends, so every range holds whole records. the header line of a file with a header stays in the first range
+def split_line_ranges(mapped, parts, header_exist=False):
+    if mapped is None:
+        return []
+    size = len(mapped)
+    data_start = 0
+    if header_exist:
+        header_end = mapped.find(b'\n')
+        data_start = size if header_end < 0 else header_end + 1
+    boundaries = [0]
+    for part in range(1, parts):
+        position = max(boundaries[-1], data_start + (size - data_start) * part // parts)
+        line_end = mapped.find(b'\n', position)
+        boundaries.append(size if line_end < 0 else line_end + 1)
+    boundaries.append(size)
+    return [(start, end) for (start, end) in zip(boundaries, boundaries[1:]) if end > start]
+
+
+# the first line of a memory mapped file, without its line end
+def read_first_line(mapped):
+    if mapped is None:
+        return b''
+    line_end = mapped.find(b'\n')
+    line = mapped[:line_end if line_end >= 0 else len(mapped)]
+    return line[:-1] if line.endswith(b'\r') else line
+
+
+# read only file over a byte range of a memory mapped file, the parsers read the range straight
+# from the page cache without the range being copied up front
+class MappedRange(io.RawIOBase):
+    def __init__(self, mapped, start, end):
+        self.view = memoryview(mapped)[start:end]
+        self.position = 0
+
+    def __repr__(self):
+        return "<%s size=%d position=%d>" % (type(self).__name__, len(self.view), self.position)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = min(len(buffer), len(self.view) - self.position)
+        buffer[:count] = self.view[self.position:self.position + count]
+        self.position += count
+        return count
+
+    # the mapping can only be closed once the view on it is released
+    def close(self):
+        if not self.closed:
+            self.view.release()
+        super().close()
@@ -0,0 +1,267 @@
+# writes the life cycle of the files [reading file, writing to kinesis] to the dynamodb metastore table
+import datetime
+import logging
+import threading
+import time
+from botocore.exceptions import ClientError
+
+# statuses of a file in the metastore, in the order of its life cycle
+FILE_STATUSES = ('reading_file', 'read_and_converted_to_df', 'processed_and_sent_to_kds', 'failed_at_file_read',
+                 'failed_at_kinesis', 'handed_off')
+# transitions that are not written on their own, their timestamp is folded into the next write of the file
+DEFERRED_STATUSES = {'read_and_converted_to_df': 'read_timestamp'}
+# progress of a partially delivered file, cleared once the file is processed
+CHECKPOINT_ATTRIBUTES = ('checkpoint_rows', 'checkpoint_timestamp')
+# batch_write_item limit
+MAX_BATCH_WRITE_ITEMS = 25
+# seconds a claim on a file keeps duplicates away, extended by every checkpoint and by the ClaimRenewer of
+# the attempt processing it. a file whose worker died is picked up again once its claim expired
+CLAIM_TTL_SECONDS = 900
+# results of claim_file: the file was picked up, this version of it was already sent to kinesis, or
+# another attempt holds a claim on it that has not expired
+FILE_CLAIMED = 'claimed'
+FILE_ALREADY_PROCESSED = 'already_processed'
+FILE_IN_PROGRESS = 'in_progress'
+# a file claimed with the same etag is a duplicate unless its last attempt failed, ran out of time
+# (handed_off, resumed by the next attempt) or its claim expired
+CLAIM_CONDITION = ("attribute_not_exists(file_name) OR attribute_not_exists(#c_etag) OR #c_etag <> :c_etag OR "
+                   "#c_status IN (:c_failed_at_file_read, :c_failed_at_kinesis, :c_handed_off) OR "
+                   "(#c_status = :c_reading_file AND #c_claim_expires < :c_now)")
+
+
+def iso_timestamp():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds')
+
+
+# records status transitions of files with at most two writes per file: one conditional upsert
+# when the file is picked up and one when it is done, intermediate transitions are folded into the
+# next write. buffered, the transitions of many files are kept in memory and written with
+# batch_write_item on flush() (or every MAX_BATCH_WRITE_ITEMS files).
+# the rows of a file acknowledged by kinesis can be saved with checkpoint(), picking the file up again
+# returns the checkpoint of the previous attempt so it can resume from there. checkpoints only survive
+# a failed attempt when unbuffered, a buffered writer always starts files from row zero. the checkpoint
+# of a handed_off file is part of its status write and survives either way.
+# claim_file() picks a file up only once per version (etag) of the file, it is always written right away.
+# a writer can be shared by the threads processing files concurrently
+class MetastoreWriter:
+    def __init__(self, table, buffered=False, claim_ttl=CLAIM_TTL_SECONDS):
+        self.table = table
+        self.buffered = buffered
+        self.claim_ttl = claim_ttl
+        self.items = {}  # file_name -> item to write on flush, buffered only
+        self.deferred = {}  # file_name -> attributes folded into the next write
+        self.resume_rows = {}  # file_name -> rows acknowledged by the previous attempt
+        self.claims_held = {}  # file_name -> claim_expires of the claim another attempt holds
+        self.lock = threading.RLock()  # guards items, a flush must not split the item of a file
+
+    def __repr__(self):
+        return "<%s table=%r buffered=%r>" % (type(self).__name__, self.table, self.buffered)
+
+    # updates dynamo db metastore status based on lifecycle of the process
+    # such as reading file, converted to datafame, send to kinesis or failed status
+    # counters (e.g. rows, bytes, delivered/retried/dropped records) are stored as attributes of the file
+    def update_file(self, status, file_name, file_format, dest_kds, reason="ok", counters=None):
+        if status not in FILE_STATUSES:
+            raise ValueError("unknown file status {}".format(status))
+        timestamp = iso_timestamp()
+        if status in DEFERRED_STATUSES:
+            self.deferred.setdefault(file_name, {})[DEFERRED_STATUSES[status]] = timestamp
+            return None
+
+        attributes = {'p_status': status, 'updated_timestamp': timestamp, 'reason': reason}
+        if status == 'reading_file':
+            attributes.update({'file_format': file_format, 'dest_kds': dest_kds, 'create_timestamp': timestamp,
+                               'reason': ''})
+        attributes.update(self.deferred.pop(file_name, {}))
+        attributes.update(counters or {})
+        if status == 'reading_file':
+            if self.buffered:
+                with self.lock:
+                    self.items[file_name] = {'file_name': file_name}
+                    self.items[file_name].update(attributes)
+                return None
+            # the item as it was before, holds the checkpoint of an earlier attempt at the file
+            response = self._upsert(file_name, attributes, return_values="ALL_OLD")
+            self._set_resume_rows(file_name, response.get('Attributes', {}))
+            return response
+
+        # a processed file is re-sent in full when it is picked up again
+        remove = CHECKPOINT_ATTRIBUTES if status == 'processed_and_sent_to_kds' else ()
+        self.resume_rows.pop(file_name, None)
+        if self.buffered:
+            with self.lock:
+                if file_name not in self.items:
+                    self.items[file_name] = {'file_name': file_name}
+                self.items[file_name].update(attributes)
+                for name in remove:
+                    self.items[file_name].pop(name, None)
+                if len(self.items) >= MAX_BATCH_WRITE_ITEMS:
+                    self.flush(finished_only=True)
+            return None
+        response = self._upsert(file_name, attributes, condition="attribute_exists(file_name)", remove=remove)
+        if response is None:
+            logging.error("file {} is not in the metastore, status {} not recorded".format(file_name, status))
+        return response
+
+    # the reading_file transition of a file as a conditional write on file_name + etag, returns
+    # FILE_CLAIMED when the file was picked up. FILE_ALREADY_PROCESSED when this version of it was already
+    # sent to kinesis (duplicate s3 notifications, redelivered messages) and FILE_IN_PROGRESS when another
+    # attempt holds a claim on it that has not expired, which may still fail and has to be retried
+    def claim_file(self, file_name, etag, file_format, dest_kds):
+        if etag is None:
+            self.update_file("reading_file", file_name, file_format, dest_kds)
+            return FILE_CLAIMED
+        self.resume_rows.pop(file_name, None)
+        timestamp = iso_timestamp()
+        attributes = {'p_status': 'reading_file', 'updated_timestamp': timestamp, 'reason': '',
+                      'file_format': file_format, 'dest_kds': dest_kds, 'create_timestamp': timestamp,
+                      'etag': etag, 'claim_expires': int(time.time()) + self.claim_ttl}
+        names = {'#c_etag': 'etag', '#c_status': 'p_status', '#c_claim_expires': 'claim_expires'}
+        values = {':c_etag': etag, ':c_failed_at_file_read': 'failed_at_file_read',
+                  ':c_failed_at_kinesis': 'failed_at_kinesis', ':c_handed_off': 'handed_off',
+                  ':c_reading_file': 'reading_file', ':c_now': int(time.time())}
+        response = self._upsert(file_name, attributes, condition=CLAIM_CONDITION, condition_names=names,
+                                condition_values=values, return_values="ALL_OLD")
+        if response is None:
+            item = self.table.get_item(Key={'file_name': file_name}, ConsistentRead=True).get('Item', {})
+            if item.get('p_status') == 'processed_and_sent_to_kds':
+                logging.info("file {} with etag {} is already processed, skipping it".format(file_name, etag))
+                return FILE_ALREADY_PROCESSED
+            logging.info("file {} with etag {} is claimed by another attempt".format(file_name, etag))
+            if 'claim_expires' in item:
+                self.claims_held[file_name] = int(item['claim_expires'])
+            return FILE_IN_PROGRESS
+        # a checkpoint of another version of the file is of no use
+        previous = response.get('Attributes', {})
+        if previous.get('etag') == etag:
+            self._set_resume_rows(file_name, previous)
+        if self.buffered:
+            with self.lock:
+                self.items[file_name] = {'file_name': file_name}
+                self.items[file_name].update(attributes)
+        return FILE_CLAIMED
+
+    def _set_resume_rows(self, file_name, previous):
+        checkpoint_rows = previous.get('checkpoint_rows')
+        if checkpoint_rows:
+            self.resume_rows[file_name] = int(checkpoint_rows)
+
+    # saves the number of rows of the file acknowledged by kinesis, an attempt picking up the file
+    # after a failure resumes after them. the claim on the file is extended along
+    def checkpoint(self, file_name, rows):
+        attributes = {'checkpoint_rows': rows, 'checkpoint_timestamp': iso_timestamp(),
+                      'claim_expires': int(time.time()) + self.claim_ttl}
+        if self.buffered:
+            with self.lock:
+                if file_name in self.items:
+                    self.items[file_name].update(attributes)
+            return None
+        response = self._upsert(file_name, attributes, condition="attribute_exists(file_name)")
+        if response is None:
+            logging.error("file {} is not in the metastore, checkpoint not recorded".format(file_name))
+        return response
+
+    # pushes the claim on a file still being read by this attempt claim_ttl seconds further. returns False
+    # when the file is not claimed with this etag anymore (its status was recorded, or another version of
+    # it was claimed)
+    def renew_claim(self, file_name, etag):
+        attributes = {'claim_expires': int(time.time()) + self.claim_ttl}
+        response = self._upsert(file_name, attributes, condition="#c_status = :c_reading_file AND #c_etag = :c_etag",
+                                condition_names={'#c_status': 'p_status', '#c_etag': 'etag'},
+                                condition_values={':c_reading_file': 'reading_file', ':c_etag': etag})
+        return response is not None
+
+    # epoch seconds the claim of the attempt holding the file expires at (unless renewed), known once
+    # claim_file() returned FILE_IN_PROGRESS. None when not known
+    def get_claim_expires(self, file_name):
+        return self.claims_held.get(file_name)
+
+    # rows of the file to skip, acknowledged by kinesis during an earlier attempt. known once the file
+    # is picked up with claim_file() or update_file("reading_file", ...)
+    def get_resume_rows(self, file_name):
+        return self.resume_rows.get(file_name, 0)
+
+    # a single update_item, which creates the item when it does not exist yet. later transitions are
+    # conditional on the item existing so a late write can't resurrect a deleted file.
+    # returns None when the condition is not met
+    def _upsert(self, file_name, attributes, condition=None, condition_names=None, condition_values=None,
+                remove=(), return_values="UPDATED_NEW"):
+        names = dict(condition_names or {})
+        values = dict(condition_values or {})
+        assignments = []
+        for (position, (name, value)) in enumerate(attributes.items()):
+            names['#a{}'.format(position)] = name
+            values[':a{}'.format(position)] = value
+            assignments.append('#a{0}=:a{0}'.format(position))
+        update_expression = "set " + ", ".join(assignments)
+        if remove:
+            removals = []
+            for (position, name) in enumerate(remove, start=len(attributes)):
+                names['#a{}'.format(position)] = name
+                removals.append('#a{}'.format(position))
+            update_expression = update_expression + " remove " + ", ".join(removals)
+        request = {
+            'Key': {'file_name': file_name},
+            'UpdateExpression': update_expression,
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': values,
+            'ReturnValues': return_values
+        }
+        if condition:
+            request['ConditionExpression'] = condition
+        try:
+            return self.table.update_item(**request)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return None
+
+    # writes the buffered items with batch_write_item, the batch writer resends unprocessed items.
+    # finished_only keeps the items of the files still being processed: put_item replaces the whole
+    # item, so a file has to be written once with all of its attributes
+    def flush(self, finished_only=False):
+        with self.lock:
+            file_names = [file_name for (file_name, item) in self.items.items()
+                          if not finished_only or item.get('p_status') != 'reading_file']
+            items = [self.items.pop(file_name) for file_name in file_names]
+        if not items:
+            return
+        with self.table.batch_writer() as batch:
+            for item in items:
+                batch.put_item(Item=item)
+        logging.info("wrote {} files to the metastore".format(len(items)))
+
+
+# renews the claim on a file from a background thread every third of the claim ttl while the file is
+# processed, so a file that takes longer than the ttl (without checkpoints) is not picked up again by a
+# duplicate notification. stops once the claim can't be renewed, e.g. when the status of the file was
+# recorded. nothing to renew for a file claimed without etag
+class ClaimRenewer:
+    def __init__(self, writer, file_name, etag):
+        self.writer = writer
+        self.file_name = file_name
+        self.etag = etag
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._renew, name="metastore-claim-renewer", daemon=True)
+
+    def __repr__(self):
+        return "<%s file_name=%r etag=%r>" % (type(self).__name__, self.file_name, self.etag)
+
+    def __enter__(self):
+        if self.etag is not None:
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def _renew(self):
+        while not self.stopped.wait(self.writer.claim_ttl / 3.0):
+            try:
+                if not self.writer.renew_claim(self.file_name, self.etag):
+                    logging.info("claim on {} is not held anymore, not renewing it".format(self.file_name))
+                    return
+            except ClientError as e:
+                logging.error("Unable to renew the claim on {}: {}".format(self.file_name, e))
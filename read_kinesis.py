@@ -3,6 +3,7 @@ import boto3
 from datetime import datetime
 import time
 
+from kpl_aggregation import deaggregate_record
 
 
 # the stream I defined in aws console
@@ -30,9 +31,10 @@ record_response = kinesis_client.get_records(ShardIterator=my_shard_iterator, Li
 while 'NextShardIterator' in record_response:
     # read up to 100 records at a time from the shard number
     record_response = kinesis_client.get_records(ShardIterator=record_response['NextShardIterator'], Limit=100)
-    # Print only if we have something
-    if (record_response['Records']):
-        print(record_response)
+    # Print only if we have something, KPL aggregated records are split back into the user records
+    for record in record_response['Records']:
+        for (partition_key, explicit_hash_key, data) in deaggregate_record(record['Data'], record['PartitionKey']):
+            print(partition_key, data)
 
     # wait for 1 seconds before looping back around to see if there is any more data to read
     time.sleep(1)
\ No newline at end of file
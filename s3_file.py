@@ -0,0 +1,119 @@
+import io
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# size of the aligned blocks fetched with ranged gets
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+# number of blocks fetched ahead of the cursor
+DEFAULT_READ_AHEAD = 4
+# memory cap of the block cache, least recently used blocks are evicted first
+DEFAULT_MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+
+# random access, read only file over an s3 object, e.g. for zipfile.ZipFile.
+# the object is read in fixed size aligned blocks with ranged gets, read_ahead blocks after the
+# cursor are fetched in parallel so sequential reads run at network bandwidth, and the blocks are
+# kept in an LRU cache of at most max_cache_bytes so the many small reads of zipfile are served
+# from memory instead of one round trip each
+class S3File(io.RawIOBase):
+    def __init__(self, s3_object, block_size=DEFAULT_BLOCK_SIZE, read_ahead=DEFAULT_READ_AHEAD,
+                 max_cache_bytes=DEFAULT_MAX_CACHE_BYTES):
+        self.s3_object = s3_object
+        self.position = 0
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        # the cache has to hold the block being read plus the read ahead ones
+        self.max_cache_blocks = max(read_ahead + 2, max_cache_bytes // block_size)
+        self.blocks = OrderedDict()  # block number -> future of the block bytes
+        self.executor = ThreadPoolExecutor(max_workers=max(1, read_ahead))
+        self._size = None
+
+    def __repr__(self):
+        return "<%s s3_object=%r>" % (type(self).__name__, self.s3_object)
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = self.s3_object.content_length
+        return self._size
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError("invalid whence (%r, should be %d, %d, %d)" % (
+                whence, io.SEEK_SET, io.SEEK_CUR, io.SEEK_END
+            ))
+
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            # Read to the end of the file
+            end = self.size
+        else:
+            end = min(self.size, self.position + size)
+        if self.position >= end:
+            return b''
+
+        pieces = []
+        while self.position < end:
+            block_number = self.position // self.block_size
+            block = self._get_block(block_number)
+            offset = self.position - block_number * self.block_size
+            piece = block[offset:offset + end - self.position]
+            pieces.append(piece)
+            self.position += len(piece)
+        self._prefetch(block_number + 1)
+        return b''.join(pieces)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.blocks.clear()
+        super().close()
+
+    def _fetch_block(self, block_number):
+        start = block_number * self.block_size
+        end = min(self.size, start + self.block_size) - 1
+        # boto3 resources are not thread safe, the underlying client is
+        response = self.s3_object.meta.client.get_object(Bucket=self.s3_object.bucket_name, Key=self.s3_object.key,
+                                                         Range="bytes=%d-%d" % (start, end))
+        return response["Body"].read()
+
+    def _submit(self, block_number):
+        future = self.blocks.get(block_number)
+        if future is None:
+            future = self.blocks[block_number] = self.executor.submit(self._fetch_block, block_number)
+        self.blocks.move_to_end(block_number)
+        while len(self.blocks) > self.max_cache_blocks:
+            (_, evicted) = self.blocks.popitem(last=False)
+            evicted.cancel()
+        return future
+
+    def _get_block(self, block_number):
+        return self._submit(block_number).result()
+
+    # queues ranged gets for the blocks after the cursor that are not cached yet and marks the
+    # cached ones as recently used, so blocks behind the cursor are evicted first
+    def _prefetch(self, block_number):
+        last_block = (self.size - 1) // self.block_size
+        for number in range(block_number, min(block_number + self.read_ahead, last_block + 1)):
+            self._submit(number)
@@ -1,132 +1,191 @@
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
-import datetime
-import pandas as pd
 import logging
 import argparse
-import io
-import zipfile
+import os
 import re
+import time
+import queue
+import threading
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from kinesis_sender import serialize_records, get_shard_count, get_partition_keys, get_explicit_hash_keys, \
+    get_shard_hash_ranges, get_throughput_limiter, backoff_delay, MAX_PUT_ATTEMPTS
+from sinks import KinesisSink, create_sink, open_sink_client
+from kpl_aggregation import aggregate_records, MAX_AGGREGATED_BYTES
+from s3_file import S3File
+from local_file import map_file, split_line_ranges, read_first_line, MappedRange
+from metastore import MetastoreWriter, ClaimRenewer, FILE_CLAIMED, FILE_IN_PROGRESS
+import arrow_csv
 
-dynamo = boto3.resource('dynamodb')
-s3 = boto3.resource('s3')
-kinesis = boto3.client('kinesis')
-
-## recommended to move to a separate file
-class S3File(io.RawIOBase):
-    def __init__(self, s3_object):
-        self.s3_object = s3_object
-        self.position = 0
-
-    def __repr__(self):
-        return "<%s s3_object=%r>" % (type(self).__name__, self.s3_object)
-
-    @property
-    def size(self):
-        return self.s3_object.content_length
-
-    def tell(self):
-        return self.position
-
-    def seek(self, offset, whence=io.SEEK_SET):
-        if whence == io.SEEK_SET:
-            self.position = offset
-        elif whence == io.SEEK_CUR:
-            self.position += offset
-        elif whence == io.SEEK_END:
-            self.position = self.size + offset
-        else:
-            raise ValueError("invalid whence (%r, should be %d, %d, %d)" % (
-                whence, io.SEEK_SET, io.SEEK_CUR, io.SEEK_END
-            ))
+# upper bound of concurrent put_records calls, sizes the connection pool of the kinesis client
+MAX_IN_FLIGHT_REQUESTS = 32
+# connections of the s3 client (ranged GETs of zip members read in parallel) and of the dynamodb
+# resource (metastore writes of the files a lambda processes concurrently)
+S3_POOL_CONNECTIONS = 32
+DYNAMO_POOL_CONNECTIONS = 16
+# number of rows parsed up front to estimate the row size when a file is chunked by bytes
+CHUNK_PROBE_ROWS = 1000
+# seconds a config item read from dynamodb is reused, warm lambdas and the sqs worker share the cache
+CONFIG_CACHE_TTL = 300
+# batch_get_item limit
+MAX_BATCH_GET_KEYS = 100
+# batch_get_item calls for the keys of a batch, unprocessed keys (throttling) are retried with backoff
+MAX_BATCH_GET_ATTEMPTS = 5
+# bytes read at a time from the streams of pass-through sources, the lines of a block make a chunk
+LINE_BLOCK_SIZE = 8 * 1024 * 1024
+# extensions pandas infers the compression of a local/NAS file from, such files can't be split in byte ranges
+COMPRESSED_EXTENSIONS = ('.gz', '.zip', '.bz2', '.xz', '.zst', '.tar')
+# csv parsers of the parser_engine config
+PARSER_ENGINES = ('pandas', 'pyarrow')
+# pandas dtypes of the types in the column_types config
+COLUMN_TYPES = {'string': str, 'int': 'Int64', 'float': 'float64', 'bool': 'boolean', 'category': 'category'}
+# comparisons of the row_filters config, in / not in have to be surrounded by spaces
+ROW_FILTER_OPERATORS = ('==', '!=', '<=', '>=', '<', '>', 'not in', 'in')
+ROW_FILTER_PATTERN = re.compile(r"^\s*(.+?)(?:\s*(==|!=|<=|>=|<|>)\s*|\s+(not in|in)\s+)(.*?)\s*$")
+# rows sent between two looks at the deadline of a time budgeted run without checkpoint_interval_rows
+DEADLINE_SLICE_ROWS = 10000
 
-        return self.position
+# (config table, service_pk, s3_location_path) -> (expiry time, config item)
+_config_cache = {}
+_dynamo_tables = {}
+# (sink type, name) -> kafka producer or appended file of send_to_sink, shared by the threads sending to it
+_sink_clients = {}
+_sink_clients_lock = threading.Lock()
 
-    def seekable(self):
-        return True
+# boto3 clients, created on first use (see get_dynamo, get_s3 and get_kinesis) so importing this module
+# (the cold start of the lambda, the spawned workers of sqs_to_process.py) costs no client set up and a
+# lambda that only skips files never creates the kinesis client. pandas, gzip and zipfile are imported
+# by the functions parsing files for the same reason
+dynamo = None
+s3 = None
+kinesis = None
+# the default boto3 session is not thread safe, clients are created one at a time
+_clients_lock = threading.Lock()
 
-    def read(self, size=-1):
-        if size == -1:
-            # Read to the end of the file
-            range_header = "bytes=%d-" % self.position
-            self.seek(offset=0, whence=io.SEEK_END)
-        else:
-            new_position = self.position + size
 
-            # If we're going to read beyond the end of the object, return
-            # the entire object.
-            if new_position >= self.size:
-                return self.read()
+def get_dynamo():
+    global dynamo
+    if dynamo is None:
+        with _clients_lock:
+            if dynamo is None:
+                dynamo = boto3.resource('dynamodb', config=Config(max_pool_connections=DYNAMO_POOL_CONNECTIONS))
+    return dynamo
+
 
-            range_header = "bytes=%d-%d" % (self.position, new_position - 1)
-            self.seek(offset=size, whence=io.SEEK_CUR)
+def get_s3():
+    global s3
+    if s3 is None:
+        with _clients_lock:
+            if s3 is None:
+                s3 = boto3.resource('s3', config=Config(max_pool_connections=S3_POOL_CONNECTIONS))
+    return s3
 
-        return self.s3_object.get(Range=range_header)["Body"].read()
 
-    def readable(self):
-        return True
+def get_kinesis():
+    global kinesis
+    if kinesis is None:
+        with _clients_lock:
+            if kinesis is None:
+                kinesis = boto3.client('kinesis', config=Config(max_pool_connections=MAX_IN_FLIGHT_REQUESTS))
+    return kinesis
 
 
 # function for sending data to Kinesis at the absolute maximum throughput
-# depending on shard size, we need to change the value/size we want to send  to
-# kinesis, here we used 9500 0r 800000bytes for 10 shards (10000 records or 10MB )
-# recommended : put it in separate file and call from here
-# the number of reocrds and bytes should be reflected by shard number of kinesis
-def send_to_kinesis(kinesis_stream_name, data):
-    kinesis_records = []  # empty list to store data
-    (rows, columns) = data.shape  # get rows and columns off provided data
-    current_bytes = 0  # counter for bytes
-    row_count = 0  # as we start with the first
-    total_row_count = rows  # using our rows variable we got earlier
-    send_kinesis = False  # flag to update when it's time to send data
-
-    for i in data.index:
-        value = data.loc[i].to_json()
-        encoded_values = bytes(value, 'utf-8')  # encode the string to bytes
-        # create a dict object of the row
-        kinesis_record = {
-            "Data": encoded_values,  # data byte-encoded
-            "PartitionKey": str(i)  # some key used to tell Kinesis which shard to use
-        }
-        kinesis_records.append(kinesis_record)  # add the object to the list
-        string_bytes = len(value.encode('utf-8'))  # get the number of bytes from the string
-        current_bytes = current_bytes + string_bytes  # keep a running total
-        # check conditional whether ready to send
-        if len(kinesis_records) == 9500:  # if we have 500 records packed up, then proceed
-            send_kinesis = True  # set the flag
-        if current_bytes > 800000:  # if the byte size is over 50000, proceed
-            send_kinesis = True  # set the flag
-        if row_count == total_row_count - 1:  # if we've reached the last record in the results
-            send_kinesis = True  # set the flag
-        # if the flag is set
-        if send_kinesis:
-            # put the records to kinesis
-            try:
-                response = kinesis.put_records(
-                    Records=kinesis_records,
-                    StreamName=kinesis_stream_name
-                )
-            except ClientError as e:
-                logging.error(
-                    "Error while trying to send data to {}, error message:{}".format(kinesis_stream_name,
-                                                                                     e.response['Error']['Message']))
-                return None
-
-            # resetting values ready for next loop
-            kinesis_records = []  # empty array
-            send_kinesis = False  # reset flag
-            current_bytes = 0  # reset bytecount
-        # regardless, make sure to incrememnt the counter for rows.
-        row_count = row_count + 1
+# the dataframe is serialized in a single pass (json or pipe record_format) by kinesis_sender and
+# packed into batches within the put_records limits (500 records / 5 MiB) and the capacity of the
+# shards of the stream. up to max_in_flight put_records calls run concurrently to drive all shards,
+# optionally paced to shard_mb_per_sec MB/s per shard. partition keys follow partition_key_strategy
+# (index, column, hash or random, see kinesis_sender.PARTITION_KEY_STRATEGIES).
+# with aggregate the rows are packed into KPL aggregated records of up to aggregation_max_bytes, the
+# delivered/retried/dropped counts then count aggregated records.
+# failed entries of a batch are re-submitted up to max_attempts times, returns the delivered/retried/dropped
+# record counts, or None when kinesis rejected a request with a non retryable error.
+# with sink_type kafka or file the records go to the kafka topic or file kinesis_stream_name instead (see
+# sinks.create_sink, sink_options), the kinesis only hash partitioning, aggregation and pacing don't apply
+def send_to_kinesis(kinesis_stream_name, data, record_format='json', max_in_flight=1, max_attempts=MAX_PUT_ATTEMPTS,
+                    shard_mb_per_sec=None, partition_key_strategy='index', partition_key_column=None, aggregate=False,
+                    aggregation_max_bytes=MAX_AGGREGATED_BYTES, sink_type='kinesis', sink_options=None):
+    (payloads, sizes) = serialize_records(data, record_format)
+    try:
+        # some key used to tell Kinesis which shard to use
+        partition_keys = get_partition_keys(data, partition_key_strategy, partition_key_column)
+    except ValueError as e:
+        logging.error("Error while trying to send data to {}, error message:{}".format(kinesis_stream_name, e))
+        return None
+    if sink_type != 'kinesis':
+        return send_to_sink(sink_type, kinesis_stream_name, payloads, sizes, partition_keys, sink_options)
+    kinesis = get_kinesis()
+    explicit_hash_keys = None
+    if partition_key_strategy == 'hash':
+        explicit_hash_keys = get_explicit_hash_keys(kinesis, kinesis_stream_name, len(payloads))
+    if aggregate:
+        (payloads, sizes, partition_keys, explicit_hash_keys) = aggregate_records(
+            payloads, partition_keys, get_shard_hash_ranges(kinesis, kinesis_stream_name), explicit_hash_keys,
+            aggregation_max_bytes)
+        logging.info("aggregated {} rows into {} kinesis records".format(data.shape[0], len(payloads)))
+    shard_count = get_shard_count(kinesis, kinesis_stream_name)
+    limiter = None
+    if shard_mb_per_sec and shard_count:
+        limiter = get_throughput_limiter(kinesis_stream_name, shard_count, shard_mb_per_sec)
+
+    try:
+        # batches within the put_records limits and what the shards take per second
+        with KinesisSink(kinesis, kinesis_stream_name, max_in_flight, max_attempts=max_attempts, limiter=limiter,
+                         shard_count=shard_count) as sink:
+            sink.add_records(payloads, partition_keys, explicit_hash_keys, sizes)
+    except ClientError as e:
+        logging.error(
+            "Error while trying to send data to {}, error message:{}".format(kinesis_stream_name,
+                                                                             e.response['Error']['Message']))
+        return None
+    except ValueError as e:
+        logging.error("Error while trying to send data to {}, error message:{}".format(kinesis_stream_name, e))
+        return None
     # log out how many records were pushed
-    logging.info('Total Records sent to Kinesis: {0}'.format(total_row_count))
-    return "OK"
+    logging.info('Total Records sent to Kinesis: {}'.format(sink.summary()))
+    return sink.counters()
+
+
+# the kafka producer or appended file of a kafka or file sink, opened once and kept open for the chunks of
+# all the files sent to it. the lock is only held to look the client up (or open it)
+def get_sink_client(sink_type, name, sink_options=None):
+    with _sink_clients_lock:
+        client = _sink_clients.get((sink_type, name))
+        if client is None:
+            client = _sink_clients[(sink_type, name)] = open_sink_client(sink_type, name, **(sink_options or {}))
+        return client
+
+
+# kafka and file sinks of send_to_kinesis. every call sends through a sink of its own on the shared client
+# (see get_sink_client), so concurrent calls don't wait for each other's flush and the counters of the sink
+# are the counts of these records only
+def send_to_sink(sink_type, name, payloads, sizes, keys, sink_options=None):
+    try:
+        sink = create_sink(sink_type, name, client=get_sink_client(sink_type, name, sink_options))
+        sink.add_records(payloads, keys, sizes=sizes)
+        sink.flush()
+    except Exception as e:
+        logging.error("Error while trying to send data to {}, error message:{}".format(name, e))
+        return None
+    logging.info('Total Records sent to {}: {}'.format(sink_type, sink.summary()))
+    return sink.counters()
+
+
+# adds the delivered/retried/dropped counts of a chunk to the totals of the file
+def add_counters(total_counters, counters):
+    for name, value in counters.items():
+        total_counters[name] = total_counters.get(name, 0) + value
+    return total_counters
 
 
 def connect_dynamo_tbl(tbl_name):
-    if not dynamo:
-        boto3.resource('dynamodb')
-    return dynamo.Table(tbl_name)
+    table = _dynamo_tables.get(tbl_name)
+    if table is None:
+        table = _dynamo_tables[tbl_name] = get_dynamo().Table(tbl_name)
+    return table
 
 
 def read_dynamo_tbl_item(tbl, key):
@@ -142,60 +201,66 @@ def read_dynamo_tbl_item(tbl, key):
             return 0, "record not found in table with key {}".format(key)
 
 
+# the config item of an s3 folder, served from the cache for CONFIG_CACHE_TTL seconds after it was read
 def read_config_dynamo(config_tbl_name, service_name, s3path):
+    cached = _config_cache.get((config_tbl_name, service_name, s3path))
+    if cached is not None and cached[0] > time.monotonic():
+        return 200, cached[1]
     config_tbl = connect_dynamo_tbl(config_tbl_name)
-    return read_dynamo_tbl_item(config_tbl, {'service_pk': service_name, 's3_location_path': s3path})
-
+    (status, response) = read_dynamo_tbl_item(config_tbl, {'service_pk': service_name, 's3_location_path': s3path})
+    if status == 200:
+        _config_cache[(config_tbl_name, service_name, s3path)] = (time.monotonic() + CONFIG_CACHE_TTL, response)
+    return status, response
 
-def item_exist(metadata_tbl, file_name):
-    (status, response) = read_dynamo_tbl_item(metadata_tbl, {'file_name': file_name})
-    if status != 200:
-        return False
-    return True
 
-# updates dynamo db metastore status based on lifecycle of the process
-# such as reading file, converted to datafame, send to kinesis or failed status
-def update_file(metadata_writer, status, file_name, file_format, dest_kds, reason="ok"):
-    if status == 'reading_file':
-        if item_exist(metadata_writer, file_name):
-            response = metadata_writer.update_item(
-                Key={
-                    'file_name': file_name
-                },
-                UpdateExpression="set p_status=:s, updated_timestamp=:uts, reason=:r, create_timestamp=:cts",
-                ExpressionAttributeValues={
-                    ':s': status,
-                    ':uts': datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S"),
-                    ':r': '',
-                    ':cts': datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-                },
-                ReturnValues="UPDATED_NEW"
-            )
+# reads the config items of many s3 folders with batch_get_item (e.g. all the files of an sqs batch)
+# into the cache, returns the items found by s3 folder. keys left unprocessed by a throttled table are
+# retried with backoff up to MAX_BATCH_GET_ATTEMPTS calls, the configs still missing then are left to
+# the callers to read one by one
+def prefetch_configs(config_tbl_name, service_name, s3paths):
+    configs = {}
+    missing = []
+    for s3path in set(s3paths):
+        cached = _config_cache.get((config_tbl_name, service_name, s3path))
+        if cached is not None and cached[0] > time.monotonic():
+            configs[s3path] = cached[1]
         else:
-            response = metadata_writer.put_item(
-                Item={
-                    'file_name': file_name,
-                    'p_status': status,
-                    'file_format': file_format,
-                    'dest_kds': dest_kds,
-                    'create_timestamp': datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-                }
-            )
-    elif status in ['read_and_converted_to_df', 'processed_and_sent_to_kds', 'failed_at_file_read',
-                    'failed_at_kinesis']:
-        response = metadata_writer.update_item(
-            Key={
-                'file_name': file_name
-            },
-            UpdateExpression="set p_status=:s, updated_timestamp=:uts, reason=:r",
-            ExpressionAttributeValues={
-                ':s': status,
-                ':uts': datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S"),
-                ':r': reason
-            },
-            ReturnValues="UPDATED_NEW"
-        )
-    return response
+            missing.append(s3path)
+    for start in range(0, len(missing), MAX_BATCH_GET_KEYS):
+        request = {config_tbl_name: {'Keys': [{'service_pk': service_name, 's3_location_path': s3path}
+                                              for s3path in missing[start:start + MAX_BATCH_GET_KEYS]]}}
+        attempt = 0
+        while request:
+            try:
+                response = get_dynamo().batch_get_item(RequestItems=request)
+            except ClientError as e:
+                raise Exception("Error while trying to read from {}, error message:{}".format(
+                    config_tbl_name, e.response['Error']['Message']))
+            for item in response['Responses'].get(config_tbl_name, []):
+                configs[item['s3_location_path']] = item
+                _config_cache[(config_tbl_name, service_name, item['s3_location_path'])] = (
+                    time.monotonic() + CONFIG_CACHE_TTL, item)
+            request = response.get('UnprocessedKeys')
+            if request:
+                attempt = attempt + 1
+                if attempt >= MAX_BATCH_GET_ATTEMPTS:
+                    logging.warning("{} config items still unprocessed after {} attempts, reading them one by "
+                                    "one".format(len(request[config_tbl_name]['Keys']), attempt))
+                    break
+                time.sleep(backoff_delay(attempt, 1.0))
+    return configs
+
+
+# drops cached config items, all of them or those of a service and/or s3 folder
+def invalidate_config_cache(service_name=None, s3path=None):
+    for key in list(_config_cache):
+        if (service_name is None or key[1] == service_name) and (s3path is None or key[2] == s3path):
+            del _config_cache[key]
+
+
+# the s3 folder of a file, the key of its config item
+def get_s3_location_path(file_path):
+    return file_path[0:file_path.rfind("/") + 1]
 
 
 def get_file_separator(file_format):
@@ -212,58 +277,566 @@ def get_file_separator(file_format):
     return sep
 
 
+# send_to_kinesis options configured for the source, the number of concurrent put_records calls
+# is capped by the client connection pool
+def get_send_options(dynamo_config):
+    max_in_flight = int(dynamo_config.get('max_in_flight_requests', 1))
+    partition_key_strategy = dynamo_config.get('partition_key_strategy', 'index')
+    if dynamo_config.get('pass_through') and partition_key_strategy == 'column':
+        # the lines of a pass-through file are not split into columns
+        logging.warning("the column partition key strategy doesn't apply to pass-through files, keyed by index")
+        partition_key_strategy = 'index'
+    return {
+        'record_format': 'raw' if dynamo_config.get('pass_through') else dynamo_config.get('dest_record_format',
+                                                                                           'json'),
+        'max_in_flight': max(1, min(max_in_flight, MAX_IN_FLIGHT_REQUESTS)),
+        'max_attempts': int(dynamo_config.get('max_put_attempts', MAX_PUT_ATTEMPTS)),
+        'shard_mb_per_sec': float(dynamo_config['shard_mb_per_sec']) if dynamo_config.get('shard_mb_per_sec') else None,
+        'partition_key_strategy': partition_key_strategy,
+        'partition_key_column': dynamo_config.get('partition_key_column'),
+        'aggregate': bool(dynamo_config.get('aggregate_records', False)),
+        'aggregation_max_bytes': int(dynamo_config.get('aggregation_max_bytes', MAX_AGGREGATED_BYTES)),
+        'sink_type': dynamo_config.get('dest_sink', 'kinesis'),
+        'sink_options': {'bootstrap_servers': parse_column_list(dynamo_config['dest_kafka_servers'])}
+        if dynamo_config.get('dest_kafka_servers') else None
+    }
+
+
+# a list of column names from the config, comma separated ("a, b") or a dynamodb list
+def parse_column_list(value):
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.split(",")
+    return [col.strip() for col in value]
+
+
+# column name -> value from a config of name:value pairs, "visitor_id:string, hits:int" or a dynamodb map
+def parse_column_map(value):
+    if not value:
+        return {}
+    if isinstance(value, str):
+        pairs = [item.split(":", 1) for item in value.split(",") if item.strip()]
+    else:
+        pairs = value.items()
+    column_map = {}
+    for pair in pairs:
+        if len(pair) != 2:
+            raise ValueError("invalid column mapping {}, expected name:value".format(":".join(pair)))
+        column_map[pair[0].strip()] = pair[1].strip()
+    return column_map
+
+
+# column name -> type name (see COLUMN_TYPES) from the column_types config
+def parse_column_types(value):
+    column_types = {}
+    for (name, type_name) in parse_column_map(value).items():
+        type_name = type_name.lower()
+        if type_name not in COLUMN_TYPES:
+            raise ValueError("unknown type {} of column {}, expected one of {}".format(
+                type_name, name, ", ".join(COLUMN_TYPES)))
+        column_types[name] = type_name
+    return column_types
+
+
+# parses the row_filters config, "column op value" predicates separated by ";" (or a dynamodb list of them)
+# that a row has to meet all of, e.g. "is_bot == 0; country in US,CA". op is one of ROW_FILTER_OPERATORS,
+# in / not in take comma separated values. returns (column, op, values) tuples
+def parse_row_filters(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(";")
+    row_filters = []
+    for predicate in value:
+        if not predicate.strip():
+            continue
+        match = ROW_FILTER_PATTERN.match(predicate)
+        if match is None:
+            raise ValueError("invalid row filter {}, expected column op value with op one of {}".format(
+                predicate.strip(), ", ".join(ROW_FILTER_OPERATORS)))
+        (column, symbol, word, values) = match.groups()
+        operator = symbol or word
+        if operator in ('in', 'not in'):
+            values = [item.strip() for item in values.split(",")]
+        else:
+            values = [values]
+        row_filters.append((column, operator, values))
+    return row_filters
+
+
+# keeps the rows of a dataframe that meet all the row filters. values are compared as numbers to
+# numeric columns, as booleans to bool columns and as strings otherwise, missing values never match
+def filter_rows(dataframe, row_filters):
+    import pandas as pd
+    mask = pd.Series(True, index=dataframe.index)
+    for (column, operator, values) in row_filters:
+        series = dataframe[column]
+        if pd.api.types.is_bool_dtype(series):
+            values = [item.lower() in ('true', '1') for item in values]
+        elif pd.api.types.is_numeric_dtype(series):
+            values = [float(item) for item in values]
+        if operator == 'in':
+            matched = series.isin(values)
+        elif operator == 'not in':
+            matched = ~series.isin(values) & series.notna()
+        elif operator == '==':
+            matched = series == values[0]
+        elif operator == '!=':
+            matched = (series != values[0]) & series.notna()
+        elif operator == '<':
+            matched = series < values[0]
+        elif operator == '<=':
+            matched = series <= values[0]
+        elif operator == '>':
+            matched = series > values[0]
+        else:
+            matched = series >= values[0]
+        mask = mask & matched.fillna(False).astype(bool)
+    return dataframe[mask]
+
+
+# parser options of the source. usecols projects the columns that are parsed, column_types gives the
+# type of columns. a typed source (column_types or raw_strings) is not inferred with convert_dtypes, its
+# columns without a type are kept as the strings of the file, and raw_strings without column_types
+# also skips the NA detection (empty fields stay empty strings). row_filters (see parse_row_filters) drop
+# rows right after parsing, their columns are parsed even when they are not in usecols.
+# parser_engine pyarrow parses with the multi-threaded pyarrow reader (see arrow_csv), sources in the
+# space format or without pyarrow installed fall back to pandas.
+# returns a dict of the read_csv options, the pyarrow options (None when parsing with pandas), the column
+# names to stitch to a file without header, whether to convert_dtypes, the row filters and the columns
+# to keep once filtered (see prepare_dataframe)
+def get_parse_options(dynamo_config):
+    header_exist = dynamo_config['header_exist']
+    column_names = dynamo_config.get('column_names')
+    usecols = parse_column_list(dynamo_config.get('usecols'))
+    column_types = parse_column_types(dynamo_config.get('column_types'))
+    dtypes = {name: COLUMN_TYPES[type_name] for (name, type_name) in column_types.items()}
+    raw_strings = bool(dynamo_config.get('raw_strings', False))
+    row_filters = parse_row_filters(dynamo_config.get('row_filters'))
+    keep_columns = None
+    if usecols:
+        filter_columns = [column for (column, _, _) in row_filters if column not in usecols]
+        if filter_columns:
+            keep_columns = usecols
+            usecols = usecols + list(dict.fromkeys(filter_columns))
+    read_options = {}
+    if header_exist:
+        columns = None
+        if usecols:
+            read_options['usecols'] = usecols
+        if column_types or raw_strings:
+            read_options['dtype'] = defaultdict(lambda: str, dtypes)
+    else:
+        # a file without header is read by position, column_names tells the positions
+        columns = parse_column_list(column_names) or []
+        if usecols:
+            unknown = [col for col in usecols if col not in columns]
+            if unknown:
+                raise ValueError("usecols {} are not in column_names {}".format(unknown, column_names))
+            positions = sorted(columns.index(col) for col in usecols)
+            read_options['usecols'] = positions
+            # in the order of the file, as pandas returns them
+            usecols = [columns[position] for position in positions]
+            column_names = ",".join(usecols)
+        else:
+            positions = range(len(columns))
+        if column_types or raw_strings:
+            read_options['dtype'] = {position: dtypes.get(columns[position], str) for position in positions}
+    if raw_strings and not column_types:
+        read_options['na_filter'] = False
+    return {
+        'read_options': read_options,
+        'arrow_options': get_arrow_options(dynamo_config, columns, usecols, column_types, raw_strings),
+        'column_names': column_names,
+        'convert_dtypes': not (column_types or raw_strings),
+        'row_filters': row_filters,
+        'keep_columns': keep_columns
+    }
+
+
+# pyarrow reader options of a source configured with parser_engine pyarrow, None to parse with pandas
+def get_arrow_options(dynamo_config, columns, usecols, column_types, raw_strings):
+    engine = dynamo_config.get('parser_engine', 'pandas')
+    if engine not in PARSER_ENGINES:
+        raise ValueError("unknown parser engine {}, expected one of {}".format(engine, ", ".join(PARSER_ENGINES)))
+    if engine == 'pandas':
+        return None
+    sep = get_file_separator(dynamo_config['source_data_format'])
+    if sep is None or len(sep) != 1:
+        logging.info("pyarrow can't parse the {} format, parsing with pandas".format(
+            dynamo_config['source_data_format']))
+        return None
+    if not arrow_csv.ARROW_AVAILABLE:
+        logging.error("pyarrow is not installed, parsing with pandas")
+        return None
+    chunk_bytes = dynamo_config.get('chunk_bytes')
+    return arrow_csv.get_arrow_options(sep, columns, usecols, column_types, raw_strings,
+                                       int(chunk_bytes) if chunk_bytes else arrow_csv.DEFAULT_BLOCK_SIZE)
+
+
 def check_file_root(file_path):
     return file_path.split("://")[0]
 
-# reads s3 file - regular, zip or gzip
-def read_s3_file(file_path, is_file_zipped, sep, header):
+# parses a whole csv stream (or local path), with pyarrow when arrow_options are set and with pandas
+# read_csv and read_options otherwise
+def parse_csv(source, sep, header, read_options=None, arrow_options=None, **kwargs):
+    if arrow_options:
+        return arrow_csv.read_csv(source, arrow_options)
+    import pandas as pd
+    return pd.read_csv(source, sep=sep, header=header, **kwargs, **(read_options or {}))
+
+
+# reads s3 file - regular, zip or gzip, read_options are passed to read_csv
+def read_s3_file(file_path, is_file_zipped, sep, header, read_options=None, arrow_options=None):
+    import pandas as pd
     (bucket, file_key) = parse_s3_file_path(file_path)
-    obj = s3.Object(bucket, file_key)
+    obj = get_s3().Object(bucket, file_key)
     if not is_file_zipped:
         body = obj.get()['Body']
-        dataframe = pd.read_csv(body, sep=sep, header=header, low_memory=False)
+        dataframe = parse_csv(body, sep, header, read_options, arrow_options, low_memory=False)
     else:
         if ".gz" in file_key:
+            import gzip
             body = obj.get()['Body']
-            dataframe = pd.read_csv(body, sep=sep, compression='gzip', header=header)
+            dataframe = parse_csv(gzip.GzipFile(fileobj=body), sep, header, read_options, arrow_options)
         elif ".zip" in file_key:
-            s3_file = S3File(obj)
-            with zipfile.ZipFile(s3_file) as zf:
-                for file in zf.namelist():
-                    with zf.open(file) as content:
-                        dataframe = pd.read_csv(content, sep=sep, header=header, low_memory=False)
+            # the members of the archive one after another, as a single dataframe
+            dataframes = []
+            for (_, content) in open_s3_file(file_path, is_file_zipped):
+                dataframes.append(parse_csv(content, sep, header, read_options, arrow_options, low_memory=False))
+            dataframe = pd.concat(dataframes, ignore_index=True)
     return dataframe
 
+# stitches the configured column names to a dataframe read from a file without header
+def apply_column_names(dataframe, header_exist, column_names):
+    if header_exist:
+        return 200, dataframe
+    columns = [col.strip() for col in column_names.split(",")]
+    if len(columns) != dataframe.shape[1]:
+        logging.info(
+            " Number of columns[{}] in the config table is {}, but the dataset had {} number of columns".format(
+                column_names, len(columns), dataframe.shape[1]))
+        return (
+            0, " Number of columns[{}] in the config table is {}, but the dataset had {} number of columns".format(
+                column_names, len(columns), dataframe.shape[1]))
+    dataframe.columns = columns
+    return 200, dataframe
+
+
+# turns a parsed dataframe into the one sent to kinesis: stitches the column names, drops the rows
+# failing the row filters and the columns only read for them, and infers the dtypes of untyped sources.
+# a file parsed in chunks is inferred from its first chunk only (chunked) and dtypes are the dtypes inferred
+# there, a later chunk is cast to them instead of being inferred on its own so the records of a file get
+# the same types whatever the chunk boundaries
+def prepare_dataframe(dataframe, header_exist, column_names, parse_options=None, dtypes=None, chunked=False):
+    parse_options = parse_options or {}
+    (status, dataframe) = apply_column_names(dataframe, header_exist, column_names)
+    if status != 200:
+        return status, dataframe
+    if parse_options.get('row_filters'):
+        dataframe = filter_rows(dataframe, parse_options['row_filters'])
+    if parse_options.get('keep_columns'):
+        dataframe = dataframe[[col for col in dataframe.columns if col in parse_options['keep_columns']]]
+    if parse_options.get('convert_dtypes', True):
+        if dtypes is None:
+            return 200, convert_chunk_dtypes(dataframe) if chunked else dataframe.convert_dtypes()
+        try:
+            dataframe = dataframe.astype(dtypes)
+        except (TypeError, ValueError) as e:
+            return 0, " Rows of the file don't fit the dtypes inferred from its first chunk {}, set column_types " \
+                      "or raw_strings to parse it in chunks, error message:{}".format(
+                          {name: str(dtype) for (name, dtype) in dtypes.items()}, e)
+    return 200, dataframe
+
+
+# convert_dtypes of the first chunk of a file parsed in chunks: float columns stay floats when the chunk
+# only holds whole numbers, later chunks may not, and integer columns are nullable for the missing values
+# of later chunks
+def convert_chunk_dtypes(dataframe):
+    dataframe = dataframe.convert_dtypes(convert_integer=False)
+    return dataframe.astype({name: 'Int64' for (name, dtype) in dataframe.dtypes.items() if dtype.kind == 'i'})
+
+
+# the dtypes inferred for the first chunk of an untyped source (see prepare_dataframe), None until a chunk
+# with rows was parsed or for a typed source
+def inferred_dtypes(dataframe, parse_options=None):
+    if not (parse_options or {}).get('convert_dtypes', True) or len(dataframe) == 0:
+        return None
+    return dataframe.dtypes.to_dict()
+
+
 # reads file with defined configuration - header_exists, file_format, file_path, is_file_zipped, column_names
 # it can read file from s3 or local/NAS  path. based on parsing file_path it
 # figures out whether file is in s3. The method can read comma, tab, space, pipe separated format
-def read_file(file_format, header_exist, column_names, file_path, is_file_zipped):
+# parse_options (see get_parse_options) project, type and filter what is parsed
+def read_file(file_format, header_exist, column_names, file_path, is_file_zipped, parse_options=None):
     header = 0 if header_exist else None
-    columns = [col.strip() for col in column_names.split(",")]
     sep = get_file_separator(file_format)
+    read_options = (parse_options or {}).get('read_options')
+    arrow_options = (parse_options or {}).get('arrow_options')
     try:
         if file_format in ('comma', 'tab', 'space', 'pipe'):
             if check_file_root(file_path) == "s3":
-                dataframe = read_s3_file(file_path, is_file_zipped, sep, header)
+                dataframe = read_s3_file(file_path, is_file_zipped, sep, header, read_options, arrow_options)
             else:
-                dataframe = pd.read_csv(file_path, sep=sep, header=header, low_memory=False)
+                dataframe = parse_csv(file_path, sep, header, read_options, arrow_options, low_memory=False)
         else:
             return 0, "unknown file format"
     except Exception as e:
         logging.error("Unable to parse file {} ".format(file_path))
         return 0, "Unable to parse file {}".format(file_path)
-    if not header_exist:
-        if len(columns) != dataframe.shape[1]:
-            logging.info(
-                " Number of columns[{}] in the config table is {}, but the dataset had {} number of columns".format(
-                    column_names, len(columns), dataframe.shape[1]))
-            return (
-                0, " Number of columns[{}] in the config table is {}, but the dataset had {} number of columns".format(
-                    column_names, len(columns), dataframe.shape[1]))
+    try:
+        return prepare_dataframe(dataframe, header_exist, column_names, parse_options)
+    except Exception as e:
+        logging.error("Unable to filter file {}: {}".format(file_path, e))
+        return 0, "Unable to filter file {}: {}".format(file_path, e)
+
+
+# opens s3 file - regular, zip or gzip - as streams that are decompressed on the fly,
+# a zip archive yields one stream per member. yields (member name, stream), the name is None but in zips
+def open_s3_file(file_path, is_file_zipped):
+    (bucket, file_key) = parse_s3_file_path(file_path)
+    obj = get_s3().Object(bucket, file_key)
+    if not is_file_zipped:
+        yield None, obj.get()['Body']
+    elif ".gz" in file_key:
+        import gzip
+        yield None, gzip.GzipFile(fileobj=obj.get()['Body'])
+    elif ".zip" in file_key:
+        import zipfile
+        with S3File(obj) as s3_file, zipfile.ZipFile(s3_file) as zf:
+            for file in get_zip_members(zf):
+                with zf.open(file) as content:
+                    yield file, content
+
+
+def get_zip_members(zf):
+    return [file for file in zf.namelist() if not file.endswith("/")]
+
+
+# pulls bounded chunks out of a pandas chunked reader. chunk_rows fixes the number of rows per chunk,
+# chunk_bytes sizes the chunks from the in-memory row size measured on the first chunk
+def iter_dataframe_chunks(reader, chunk_rows=None, chunk_bytes=None):
+    rows = chunk_rows if chunk_rows else CHUNK_PROBE_ROWS
+    estimate_rows = bool(chunk_bytes)
+    while True:
+        try:
+            dataframe = reader.get_chunk(rows)
+        except StopIteration:
+            return
+        if estimate_rows and len(dataframe) > 0:
+            row_bytes = dataframe.memory_usage(deep=True, index=False).sum() / len(dataframe)
+            rows = max(1, int(chunk_bytes / max(row_bytes, 1)))
+            if chunk_rows:
+                rows = min(rows, chunk_rows)
+            estimate_rows = False
+        yield dataframe
+
+
+# parses one stream (a local file, s3 body or zip member) into dataframes of bounded size, or into a
+# single dataframe without chunk_rows and chunk_bytes. the chunks of a zip member carry its name in
+# attrs['member']. dtypes, when inferred already for another part of the file, are the dtypes the chunks
+# of an untyped source are cast to (see prepare_dataframe)
+def read_stream_chunks(stream, member, header_exist, column_names, sep, header, chunk_rows=None, chunk_bytes=None,
+                       parse_options=None, dtypes=None):
+    parse_options = parse_options or {}
+    arrow_options = parse_options.get('arrow_options')
+    import pandas as pd
+    reader = None
+    if not chunk_rows and not chunk_bytes:
+        dataframes = [parse_csv(stream, sep, header, parse_options.get('read_options'), arrow_options,
+                                low_memory=False)]
+    elif arrow_options:
+        # the blocks of the pyarrow reader are sized by chunk_bytes already
+        dataframes = arrow_csv.iter_csv_chunks(stream, arrow_options, chunk_rows)
+    else:
+        reader = pd.read_csv(stream, sep=sep, header=header, iterator=True, chunksize=CHUNK_PROBE_ROWS,
+                             **parse_options.get('read_options', {}))
+        dataframes = iter_dataframe_chunks(reader, chunk_rows, chunk_bytes)
+    try:
+        for dataframe in dataframes:
+            (status, dataframe) = prepare_dataframe(dataframe, header_exist, column_names, parse_options, dtypes,
+                                                    chunked=bool(chunk_rows or chunk_bytes))
+            if status != 200:
+                raise ValueError(dataframe)
+            if dtypes is None:
+                dtypes = inferred_dtypes(dataframe, parse_options)
+            if member is not None:
+                dataframe.attrs['member'] = member
+            yield dataframe
+    finally:
+        if reader is not None:
+            reader.close()
+
+
+# reads the members of a zip archive on s3 in member_workers threads, each member is decompressed and
+# parsed by a thread of its own (see read_stream_chunks) and the chunks of all the members are yielded in
+# the order they are parsed. a failed member raises its error once its earlier chunks were yielded
+def read_zip_members_parallel(file_path, member_workers, read_member):
+    (bucket, file_key) = parse_s3_file_path(file_path)
+    # (chunk, None) for every chunk and (None, error or None) when a member is done
+    chunks = queue.Queue(maxsize=member_workers * 2)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(zf, member):
+        try:
+            with zf.open(member) as content:
+                for dataframe in read_member(member, content):
+                    if not put((dataframe, None)):
+                        return
+        except Exception as e:
+            put((None, e))
+        else:
+            put((None, None))
+
+    import zipfile
+    with S3File(get_s3().Object(bucket, file_key)) as s3_file, zipfile.ZipFile(s3_file) as zf, \
+            ThreadPoolExecutor(max_workers=member_workers) as executor:
+        members = get_zip_members(zf)
+        for member in members:
+            executor.submit(read, zf, member)
+        try:
+            remaining = len(members)
+            while remaining:
+                (dataframe, error) = chunks.get()
+                if dataframe is not None:
+                    yield dataframe
+                    continue
+                if error is not None:
+                    raise error
+                remaining = remaining - 1
+        finally:
+            stopped.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+# streaming counterpart of read_file, yields dataframes of bounded size straight from the
+# s3 body, gzip stream or zip members (or local/NAS file) so memory stays flat regardless of file size.
+# without chunk_rows and chunk_bytes every zip member is a chunk, with member_workers above 1 that many
+# members of a zip archive are read in parallel
+def read_file_chunks(file_format, header_exist, column_names, file_path, is_file_zipped, chunk_rows=None,
+                     chunk_bytes=None, parse_options=None, member_workers=1):
+    if file_format not in ('comma', 'tab', 'space', 'pipe'):
+        raise ValueError("unknown file format")
+    header = 0 if header_exist else None
+    sep = get_file_separator(file_format)
+
+    def read_member(member, stream):
+        return read_stream_chunks(stream, member, header_exist, column_names, sep, header, chunk_rows,
+                                  chunk_bytes, parse_options)
+
+    return read_file_streams(file_path, is_file_zipped, read_member, member_workers)
+
+
+# reads the streams of a file - the s3 body, gzip stream, each zip member (member_workers at a time) or the
+# local/NAS path - with read_member(member name, stream), yields what it yields
+def read_file_streams(file_path, is_file_zipped, read_member, member_workers=1):
+    if check_file_root(file_path) == "s3":
+        if member_workers > 1 and is_zip_archive(file_path, is_file_zipped):
+            yield from read_zip_members_parallel(file_path, member_workers, read_member)
+            return
+        streams = open_s3_file(file_path, is_file_zipped)
+    else:
+        streams = [(None, file_path)]
+    for (member, stream) in streams:
+        yield from read_member(member, stream)
+
+
+# the header line of a pass-through source with the columns renamed as in renames (old name -> new name)
+def rename_header(header_line, sep, renames):
+    if not renames:
+        return header_line
+    delimiter = ' ' if sep == r'\s+' else sep
+    names = header_line.decode('utf-8').split() if sep == r'\s+' else header_line.decode('utf-8').split(sep)
+    return delimiter.join(renames.get(name.strip(), name) for name in names).encode('utf-8')
+
+
+# pass-through counterpart of read_stream_chunks: splits a decompressed byte stream into its lines without
+# parsing them, block_size bytes at a time, and yields them as one column ('line') dataframes of bytes
+# indexed by line number, of at most chunk_rows lines. blank lines are skipped like pandas does, the
+# header line of a file with a header is dropped or, when header_renames is not None, sent first with
+# its columns renamed (see rename_header)
+def read_stream_lines(stream, member, header_exist, sep, chunk_rows=None, block_size=LINE_BLOCK_SIZE,
+                      header_renames=None):
+    import pandas as pd
+    if isinstance(stream, str):
+        import gzip
+        with (gzip.open(stream, 'rb') if stream.endswith(".gz") else open(stream, 'rb')) as file:
+            yield from read_stream_lines(file, member, header_exist, sep, chunk_rows, block_size, header_renames)
+        return
+    line_number = 0
+    header_pending = header_exist
+    carry = b''
+    while True:
+        block = stream.read(block_size)
+        if block:
+            # a single split in c, the partial last line is carried over to the next block
+            data = carry + block if carry else block
+            lines = data.split(b'\n')
+            carry = lines.pop()
+        elif carry:
+            (data, lines, carry) = (carry, [carry], b'')
         else:
-            dataframe.columns = columns
-    dataframe_with_datatype = dataframe.convert_dtypes()
-    return 200, dataframe_with_datatype
+            return
+        # \r\n line ends, looked for in the carried line too as its \r may have come with an earlier block
+        if b'\r' in data:
+            lines = [line[:-1] if line.endswith(b'\r') else line for line in lines]
+        if not all(lines):
+            lines = [line for line in lines if line]
+        if header_pending and lines:
+            header_pending = False
+            header_line = lines.pop(0)
+            if header_renames is not None:
+                lines.insert(0, rename_header(header_line, sep, header_renames))
+        if not lines:
+            continue
+        dataframe = pd.DataFrame({'line': lines}, index=pd.RangeIndex(line_number, line_number + len(lines)))
+        line_number = line_number + len(lines)
+        if member is not None:
+            dataframe.attrs['member'] = member
+        yield from iter_row_slices(dataframe, chunk_rows)
+
+
+# pass-through counterpart of read_file_chunks, yields the lines of the file unparsed (see read_stream_lines)
+def read_file_lines(file_format, header_exist, file_path, is_file_zipped, chunk_rows=None, chunk_bytes=None,
+                    member_workers=1, header_renames=None):
+    if file_format not in ('comma', 'tab', 'space', 'pipe'):
+        raise ValueError("unknown file format")
+    sep = get_file_separator(file_format)
+
+    def read_member(member, stream):
+        return read_stream_lines(stream, member, header_exist, sep, chunk_rows, chunk_bytes or LINE_BLOCK_SIZE,
+                                 header_renames)
+
+    return read_file_streams(file_path, is_file_zipped, read_member, member_workers)
+
+
+def is_zip_archive(file_path, is_file_zipped):
+    return bool(is_file_zipped) and ".zip" in file_path
+
+
+# identifies the version of a file for the metastore claim: the etag of an s3 object, the size and
+# modification time of a local/NAS file. None when the file can't be looked up, the read reports why
+def get_file_etag(file_path):
+    try:
+        if check_file_root(file_path) == "s3":
+            (bucket, file_key) = parse_s3_file_path(file_path)
+            return get_s3().Object(bucket, file_key).e_tag.strip('"')
+        stat = os.stat(file_path)
+        return "{}-{}".format(stat.st_size, stat.st_mtime_ns)
+    except (ClientError, OSError) as e:
+        logging.error("Unable to look up the etag of {}: {}".format(file_path, e))
+        return None
 
 
 def parse_s3_file_path(s3_loc):
@@ -273,51 +846,373 @@ def parse_s3_file_path(s3_loc):
     s3_path = s3loc_array[index + 1:len(s3loc_array)]
     return bucket, s3_path
 
+# splits a dataframe into slices of at most slice_rows rows, the whole dataframe without slice_rows
+def iter_row_slices(dataframe, slice_rows=None):
+    if not slice_rows or dataframe.shape[0] <= slice_rows:
+        yield dataframe
+        return
+    for start in range(0, dataframe.shape[0], slice_rows):
+        yield dataframe.iloc[start:start + slice_rows]
+
+
+# drops the first skip_rows rows of a sequence of chunks, e.g. the rows a previous attempt delivered
+def skip_chunk_rows(chunks, skip_rows):
+    skipped = 0
+    for dataframe in chunks:
+        if skipped < skip_rows:
+            rows = min(skip_rows - skipped, dataframe.shape[0])
+            skipped = skipped + rows
+            dataframe = dataframe.iloc[rows:]
+            if dataframe.shape[0] == 0:
+                continue
+        yield dataframe
+
+
+# raised by run_process when a time budgeted run stops at its deadline, the rows of the file sent so
+# far are checkpointed in the metastore and another attempt at the file resumes after them
+class FileHandedOff(Exception):
+    def __init__(self, file_path, rows):
+        super().__init__("{} handed off after {} rows".format(file_path, rows))
+        self.file_path = file_path
+        self.rows = rows
+
+
+# raised by run_process when another attempt holds an unexpired claim on the file, that attempt may still
+# fail so the file has to be retried later rather than dropped as a duplicate. claim_expires is the epoch
+# second the claim expires at unless it is renewed, None when not known
+class FileInProgress(Exception):
+    def __init__(self, file_path, claim_expires=None):
+        super().__init__("{} is being processed by another attempt".format(file_path))
+        self.file_path = file_path
+        self.claim_expires = claim_expires
+
+
+# sends the chunks of a file to kinesis, each one as soon as it is parsed.
+# with checkpoint_interval_rows in the config, chunks are sent in slices of at most that many rows and
+# the rows acknowledged by kinesis are checkpointed in the metastore every checkpoint_interval_rows rows
+# (and with the failure status), so a retry resumes after resume_rows rows instead of re-sending the file.
+# with a deadline (time.monotonic()) no slice is sent once it passed: the file is recorded as handed_off
+# with its checkpoint and FileHandedOff is raised
+def send_file_chunks(metadata_writer, dynamo_config, file_path, chunks, resume_rows=0, deadline=None):
+    checkpoint_interval = dynamo_config.get('checkpoint_interval_rows')
+    checkpoint_interval = int(checkpoint_interval) if checkpoint_interval else None
+    slice_rows = checkpoint_interval or (DEADLINE_SLICE_ROWS if deadline is not None else None)
+    if resume_rows:
+        logging.info("resuming file {} after {} rows".format(file_path, resume_rows))
+        chunks = skip_chunk_rows(chunks, resume_rows)
+    send_options = get_send_options(dynamo_config)
+    total_row_count = resume_rows
+    checkpoint_rows = resume_rows
+    chunk_count = 0
+    total_counters = {'row_count': total_row_count}
+    member_row_counts = {}
+    if resume_rows:
+        total_counters['resumed_at_rows'] = resume_rows
+    while True:
+        try:
+            dataframe = next(chunks)
+        except StopIteration:
+            break
+        except Exception as e:
+            # update status of file to "failed_at_file_read"
+            logging.error("Unable to parse file {} ".format(file_path))
+            if checkpoint_interval:
+                total_counters['checkpoint_rows'] = total_row_count
+            metadata_writer.update_file("failed_at_file_read", file_path, dynamo_config['source_data_format'],
+                                        dynamo_config['dest_kds_stream'],
+                                        reason="Unable to parse file {}: {}".format(file_path, e),
+                                        counters=total_counters)
+            logging.info("failed at file reading {}".format(e))
+            exit(1)
+        if chunk_count == 0:
+            # update status of file to "read_and_converted_to_df" once the first chunk is parsed
+            metadata_writer.update_file("read_and_converted_to_df", file_path, dynamo_config['source_data_format'],
+                                        dynamo_config['dest_kds_stream'])
+            logging.info("started sending data to kinesis")
+        for rows in iter_row_slices(dataframe, slice_rows):
+            if deadline is not None and time.monotonic() >= deadline:
+                total_counters['checkpoint_rows'] = total_row_count
+                metadata_writer.update_file("handed_off", file_path, dynamo_config['source_data_format'],
+                                            dynamo_config['dest_kds_stream'], reason="out of time",
+                                            counters=total_counters)
+                logging.info("out of time after {} rows of {}".format(total_row_count, file_path))
+                raise FileHandedOff(file_path, total_row_count)
+            response = send_to_kinesis(dynamo_config['dest_kds_stream'], rows, **send_options)
+            if response is not None:
+                add_counters(total_counters, response)
+            if response is None or response['dropped_records'] > 0:
+                # update status of file to "failed_at_kinesis", the rows of the slice are sent again on retry
+                if checkpoint_interval:
+                    total_counters['checkpoint_rows'] = total_row_count
+                metadata_writer.update_file("failed_at_kinesis", file_path, dynamo_config['source_data_format'],
+                                            dynamo_config['dest_kds_stream'], reason="error writing at kinesis",
+                                            counters=total_counters)
+                logging.info("failed at kinesis after {} rows".format(total_row_count))
+                exit(1)
+            total_row_count = total_row_count + rows.shape[0]
+            total_counters['row_count'] = total_row_count
+            if 'member' in rows.attrs:
+                # rows sent per zip member
+                member = rows.attrs['member']
+                member_row_counts[member] = member_row_counts.get(member, 0) + rows.shape[0]
+                total_counters['member_row_counts'] = member_row_counts
+            if checkpoint_interval and total_row_count - checkpoint_rows >= checkpoint_interval:
+                metadata_writer.checkpoint(file_path, total_row_count)
+                checkpoint_rows = total_row_count
+        chunk_count = chunk_count + 1
+    # update status of file to "processed_and_sent_to_kds"
+    metadata_writer.update_file("processed_and_sent_to_kds", file_path, dynamo_config['source_data_format'],
+                                dynamo_config['dest_kds_stream'], counters=total_counters)
+    logging.info("sent {} rows in {} chunks".format(total_row_count - resume_rows, chunk_count))
+
+
+# reads the file chunk by chunk and sends every chunk to kinesis as soon as it is parsed,
+# so the first records ship without waiting for the whole file.
+# with zip_member_workers above 1 the members of a zip archive are read in parallel, their chunks then
+# come in no fixed order so such files are not checkpointed (nor stopped at a deadline)
+def stream_file_to_kinesis(metadata_writer, dynamo_config, file_path, resume_rows=0, deadline=None):
+    chunk_rows = dynamo_config.get('chunk_rows')
+    chunk_bytes = dynamo_config.get('chunk_bytes')
+    member_workers = int(dynamo_config.get('zip_member_workers', 1))
+    if member_workers > 1 and is_zip_archive(file_path, dynamo_config['is_file_zipped']):
+        if resume_rows or dynamo_config.get('checkpoint_interval_rows'):
+            logging.info("members of {} are read in parallel, the file is not checkpointed".format(file_path))
+        dynamo_config = dict(dynamo_config, checkpoint_interval_rows=None)
+        resume_rows = 0
+        deadline = None
+    if dynamo_config.get('pass_through'):
+        header_renames = None
+        if dynamo_config.get('pass_through_header'):
+            header_renames = parse_column_map(dynamo_config.get('column_renames'))
+        chunks = read_file_lines(dynamo_config['source_data_format'], dynamo_config['header_exist'], file_path,
+                                 dynamo_config['is_file_zipped'], chunk_rows=int(chunk_rows) if chunk_rows else None,
+                                 chunk_bytes=int(chunk_bytes) if chunk_bytes else None,
+                                 member_workers=member_workers, header_renames=header_renames)
+        send_file_chunks(metadata_writer, dynamo_config, file_path, chunks, resume_rows, deadline)
+        return
+    parse_options = get_parse_options(dynamo_config)
+    chunks = read_file_chunks(dynamo_config['source_data_format'], dynamo_config['header_exist'],
+                              parse_options['column_names'], file_path, dynamo_config['is_file_zipped'],
+                              chunk_rows=int(chunk_rows) if chunk_rows else None,
+                              chunk_bytes=int(chunk_bytes) if chunk_bytes else None, parse_options=parse_options,
+                              member_workers=member_workers)
+    send_file_chunks(metadata_writer, dynamo_config, file_path, chunks, resume_rows, deadline)
+
+
+# runs in a worker process of send_local_file_parallel: sends the records of the byte range [start, end) of a
+# local/NAS file to kinesis with the kinesis client of the process. returns the status of the range, the
+# reason of a failure and the counters of the range. dtypes are the dtypes of the file (see infer_range_dtypes)
+def send_local_range(dynamo_config, file_path, start, end, dtypes=None):
+    chunk_rows = int(dynamo_config['chunk_rows']) if dynamo_config.get('chunk_rows') else None
+    chunk_bytes = int(dynamo_config['chunk_bytes']) if dynamo_config.get('chunk_bytes') else None
+    sep = get_file_separator(dynamo_config['source_data_format'])
+    send_options = get_send_options(dynamo_config)
+    counters = {'row_count': 0}
+    with open(file_path, 'rb') as file, map_file(file) as mapped, MappedRange(mapped, start, end) as stream:
+        if dynamo_config.get('pass_through'):
+            header_renames = None
+            if dynamo_config.get('pass_through_header'):
+                header_renames = parse_column_map(dynamo_config.get('column_renames'))
+            chunks = read_stream_lines(stream, None, dynamo_config['header_exist'], sep, chunk_rows,
+                                       chunk_bytes or LINE_BLOCK_SIZE, header_renames)
+        else:
+            parse_options = get_parse_options(dynamo_config)
+            chunks = read_stream_chunks(stream, None, dynamo_config['header_exist'], parse_options['column_names'],
+                                        sep, 0 if dynamo_config['header_exist'] else None, chunk_rows, chunk_bytes,
+                                        parse_options, dtypes)
+        try:
+            while True:
+                try:
+                    dataframe = next(chunks)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    return "failed_at_file_read", "Unable to parse file {} bytes {}-{}: {}".format(
+                        file_path, start, end, e), counters
+                response = send_to_kinesis(dynamo_config['dest_kds_stream'], dataframe, **send_options)
+                if response is not None:
+                    add_counters(counters, response)
+                if response is None or response['dropped_records'] > 0:
+                    return "failed_at_kinesis", "error writing at kinesis", counters
+                counters['row_count'] = counters['row_count'] + dataframe.shape[0]
+        finally:
+            chunks.close()
+    return "processed_and_sent_to_kds", "ok", counters
+
+
+# the dtypes of an untyped source sent in byte ranges, inferred from the first chunk with rows of its first
+# range and given to every range, so the ranges are cast alike instead of each inferring its own dtypes.
+# None for typed and pass-through sources
+def infer_range_dtypes(dynamo_config, file_path, start, end):
+    if dynamo_config.get('pass_through'):
+        return None
+    parse_options = get_parse_options(dynamo_config)
+    if not parse_options['convert_dtypes']:
+        return None
+    chunk_rows = int(dynamo_config['chunk_rows']) if dynamo_config.get('chunk_rows') else None
+    chunk_bytes = int(dynamo_config['chunk_bytes']) if dynamo_config.get('chunk_bytes') else None
+    sep = get_file_separator(dynamo_config['source_data_format'])
+    with open(file_path, 'rb') as file, map_file(file) as mapped, MappedRange(mapped, start, end) as stream:
+        # the first chunk the range is parsed in, or CHUNK_PROBE_ROWS rows when it is parsed in one piece
+        chunks = read_stream_chunks(stream, None, dynamo_config['header_exist'], parse_options['column_names'],
+                                    sep, 0 if dynamo_config['header_exist'] else None,
+                                    chunk_rows or (None if chunk_bytes else CHUNK_PROBE_ROWS), chunk_bytes,
+                                    parse_options)
+        try:
+            for dataframe in chunks:
+                dtypes = inferred_dtypes(dataframe, parse_options)
+                if dtypes is not None:
+                    return dtypes
+        finally:
+            chunks.close()
+    return None
+
+
+# sends an uncompressed local/NAS file with `workers` processes so a single large file is pumped with all
+# the cores: the file is memory mapped and split into byte ranges at line ends, which the worker processes
+# parse (or pass through) and send with kinesis senders of their own. the first range holds the header of
+# a file with a header, the other ranges are read as files without header with the names of that header.
+# an untyped source gets the dtypes of its first chunk in all the ranges (see infer_range_dtypes).
+# the ranges complete in no fixed order so such files are not checkpointed
+def send_local_file_parallel(metadata_writer, dynamo_config, file_path, workers):
+    with open(file_path, 'rb') as file:
+        mapped = map_file(file)
+        try:
+            ranges = split_line_ranges(mapped, workers, dynamo_config['header_exist'])
+            header_line = read_first_line(mapped) if dynamo_config['header_exist'] else None
+        finally:
+            if mapped is not None:
+                mapped.close()
+    range_configs = [dynamo_config] * len(ranges)
+    if header_line is not None and len(ranges) > 1:
+        sep = get_file_separator(dynamo_config['source_data_format'])
+        header = header_line.decode('utf-8')
+        names = header.split() if sep == r'\s+' else header.split(sep)
+        headerless_config = dict(dynamo_config, header_exist=False,
+                                 column_names=",".join(name.strip().strip('"') for name in names))
+        range_configs = [dynamo_config] + [headerless_config] * (len(ranges) - 1)
+    dtypes = infer_range_dtypes(dynamo_config, file_path, *ranges[0]) if len(ranges) > 1 else None
+    logging.info("sending {} in {} byte ranges with {} processes".format(file_path, len(ranges), workers))
+
+    total_counters = {'row_count': 0}
+    failure = None
+    # spawn, the boto3 clients of this process must not be shared with forked children
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(send_local_range, range_config, file_path, start, end, dtypes)
+                   for (range_config, (start, end)) in zip(range_configs, ranges)]
+        for future in futures:
+            (status, reason, counters) = future.result()
+            add_counters(total_counters, counters)
+            if status != "processed_and_sent_to_kds" and failure is None:
+                failure = (status, reason)
+                logging.error("{} of {}: {}".format(status, file_path, reason))
+    if failure is not None:
+        metadata_writer.update_file(failure[0], file_path, dynamo_config['source_data_format'],
+                                    dynamo_config['dest_kds_stream'], reason=failure[1], counters=total_counters)
+        exit(1)
+    metadata_writer.update_file("read_and_converted_to_df", file_path, dynamo_config['source_data_format'],
+                                dynamo_config['dest_kds_stream'])
+    metadata_writer.update_file("processed_and_sent_to_kds", file_path, dynamo_config['source_data_format'],
+                                dynamo_config['dest_kds_stream'], counters=total_counters)
+    logging.info("sent {} rows in {} byte ranges".format(total_counters['row_count'], len(ranges)))
+
+
 # starts the process, connects to dynamodb to read config and meta table
 # reads the file from s3 and writes to kinesis
 # keeps track of life cycle [reading file, writing to kinesis] in dynamodb meta table
-def run_process(config_table, meta_table, service_type, file_path):
-    (status, dynamo_config) = read_config_dynamo(config_table, service_type, file_path[0:file_path.rfind("/") + 1])
-    if status == 0:
-        raise Exception(dynamo_config)
+# when the config defines chunk_rows or chunk_bytes the file is streamed in chunks instead of
+# being loaded into a single dataframe, zip archives and pass-through sources are always streamed.
+# a config item already read (e.g. by prefetch_configs) can be passed as dynamo_config.
+# status transitions go through metadata_writer, by default an unbuffered MetastoreWriter on meta_table.
+# the file is claimed in the metastore by its etag (looked up when not passed, e.g. from an s3 event)
+# before it is read, returns False without reading it when this version of the file was already
+# processed and raises FileInProgress when another attempt holds a claim on it, True once it was sent.
+# the claim is renewed while the file is sent (see ClaimRenewer), an error after the claim records a
+# failure status, which releases the claim for a retry.
+# with a deadline (time.monotonic()) the file is sent until the deadline and FileHandedOff is raised when
+# rows are left, local files sent by local_workers processes are not stopped
+def run_process(config_table, meta_table, service_type, file_path, dynamo_config=None, metadata_writer=None,
+                etag=None, deadline=None):
+    if dynamo_config is None:
+        (status, dynamo_config) = read_config_dynamo(config_table, service_type, get_s3_location_path(file_path))
+        if status == 0:
+            raise Exception(dynamo_config)
 
     logging.info(dynamo_config)
     # read/write file status to dynamodb
-    metadata_writer = connect_dynamo_tbl(meta_table)
+    if metadata_writer is None:
+        metadata_writer = MetastoreWriter(connect_dynamo_tbl(meta_table))
 
-    # insert loading status for file
-    update_file(metadata_writer, "reading_file", file_path, dynamo_config['source_data_format'],
-                dynamo_config['dest_kds_stream'])
+    # insert loading status for file, a file picked up again after a failure resumes from its checkpoint
+    if etag is None:
+        etag = get_file_etag(file_path)
+    claim = metadata_writer.claim_file(file_path, etag, dynamo_config['source_data_format'],
+                                       dynamo_config['dest_kds_stream'])
+    if claim == FILE_IN_PROGRESS:
+        raise FileInProgress(file_path, metadata_writer.get_claim_expires(file_path))
+    if claim != FILE_CLAIMED:
+        logging.info("file {} is a duplicate, not sending it again".format(file_path))
+        return False
+    try:
+        # the claim outlives the claim ttl while the file is read and sent
+        with ClaimRenewer(metadata_writer, file_path, etag):
+            send_claimed_file(metadata_writer, dynamo_config, file_path, deadline)
+    except (FileHandedOff, SystemExit):
+        # the status of the file is recorded already
+        raise
+    except Exception as e:
+        # any other error releases the claim with a failure status, so a retry can pick the file up
+        logging.error("Processing of {} failed: {!r}".format(file_path, e))
+        try:
+            metadata_writer.update_file("failed_at_file_read", file_path, dynamo_config['source_data_format'],
+                                        dynamo_config['dest_kds_stream'], reason="{!r}".format(e))
+        except Exception as status_error:
+            logging.error("Unable to record the failure of {}: {!r}".format(file_path, status_error))
+        raise
+    return True
+
+
+# reads and sends a file claimed by run_process, records its final status in the metastore
+def send_claimed_file(metadata_writer, dynamo_config, file_path, deadline=None):
+    resume_rows = metadata_writer.get_resume_rows(file_path)
+    local_workers = int(dynamo_config.get('local_workers', 1))
+    if local_workers > 1 and check_file_root(file_path) != "s3" and (
+            dynamo_config['is_file_zipped'] or file_path.lower().endswith(COMPRESSED_EXTENSIONS)):
+        # compressed bytes have no line ends to split at, the decompressed file is streamed in one process
+        logging.info("{} is compressed, streaming it instead of splitting it for {} workers".format(
+            file_path, local_workers))
+        stream_file_to_kinesis(metadata_writer, dynamo_config, file_path, resume_rows, deadline)
+        logging.info("Process finished")
+        return
+    if local_workers > 1 and check_file_root(file_path) != "s3":
+        if resume_rows or dynamo_config.get('checkpoint_interval_rows'):
+            logging.info("{} is sent by parallel workers, the file is not checkpointed".format(file_path))
+        send_local_file_parallel(metadata_writer, dynamo_config, file_path, local_workers)
+        logging.info("Process finished")
+        return
+    if dynamo_config.get('chunk_rows') or dynamo_config.get('chunk_bytes') or dynamo_config.get('pass_through') or \
+            is_zip_archive(file_path, dynamo_config['is_file_zipped']):
+        logging.info("streaming file ..")
+        stream_file_to_kinesis(metadata_writer, dynamo_config, file_path, resume_rows, deadline)
+        logging.info("Process finished")
+        return
     # read s3 file
     logging.info("reading file ..")
+    parse_options = get_parse_options(dynamo_config)
     read_response = read_file(dynamo_config['source_data_format'], dynamo_config['header_exist'],
-                              dynamo_config['column_names'], file_path, dynamo_config['is_file_zipped'])
+                              parse_options['column_names'], file_path, dynamo_config['is_file_zipped'],
+                              parse_options)
 
     if read_response[0] == 200:
-        # update status of file to "read_and_converted_to_df"
-        update_file(metadata_writer, "read_and_converted_to_df", file_path, dynamo_config['source_data_format'],
-                    dynamo_config['dest_kds_stream'])
         logging.info(" read file successfully & converted to dataframe.")
     else:
         # update status of file to "failed_at_file_read"
-        update_file(metadata_writer, "failed_at_file_read", file_path, dynamo_config['source_data_format'],
-                    dynamo_config['dest_kds_stream'], reason=read_response[1])
+        metadata_writer.update_file("failed_at_file_read", file_path, dynamo_config['source_data_format'],
+                                    dynamo_config['dest_kds_stream'], reason=read_response[1])
         logging.info("failed at file reading {}".format(read_response[1]))
         exit(1)
-    dataframe = read_response[1]
-    # send data to kinesis
-    logging.info("started sending data to kinesis")
-    response = send_to_kinesis(dynamo_config['dest_kds_stream'], dataframe)
-    if response is not None:
-        # update status of file to "processed_and_sent_to_kds"
-        update_file(metadata_writer, "processed_and_sent_to_kds", file_path, dynamo_config['source_data_format'],
-                    dynamo_config['dest_kds_stream'])
-    else:
-        # update status of file to "failed_at_kinesis"
-        update_file(metadata_writer, "failed_at_kinesis", file_path, dynamo_config['source_data_format'],
-                    dynamo_config['dest_kds_stream'], reason="error writing at kinesis")
-        logging.info("failed at kinesis")
-        exit(1)
+    # send data to kinesis, the whole dataframe as a single chunk
+    send_file_chunks(metadata_writer, dynamo_config, file_path, iter([read_response[1]]), resume_rows, deadline)
     logging.info("Process finished")
 
 
@@ -351,6 +1246,46 @@ def main(args):
 #     column_names - name of the columns in comma separated. This is required if
 #                    header_exists is false and we want to stitch column header to data
 #                    at present it is required if header_exists is false
+#     chunk_rows - optional, streams the file to kinesis in chunks of this many rows
+#     chunk_bytes - optional, streams the file to kinesis in chunks of roughly this many bytes in memory
+#     usecols - optional, comma separated names of the columns to read and send, the other columns are not parsed
+#     column_types - optional, types of columns as name:type pairs (string, int, float, bool, category), e.g.
+#                    "visitor_id:string, hits:int". columns without a type are sent as the strings of the file
+#                    and the types are not inferred
+#     raw_strings - optional boolean, sends every column as the strings of the file without type inference
+#                   or NA detection (fastest parsing)
+#     row_filters - optional, rows to send as "column op value" predicates separated by ";", all of which a row
+#                   has to meet, e.g. "is_bot == 0; country in US,CA". op is ==, !=, <, <=, >, >=, in or not in.
+#                   the other rows are dropped right after parsing and their column need not be in usecols
+#     zip_member_workers - optional, number of members of a zip archive read in parallel (default 1, in order).
+#                          the rows sent per member are recorded in the metastore as member_row_counts
+#     pass_through - optional boolean, sends the lines of the file as they are (raw records, e.g. for
+#                    pipe delimited destinations) without parsing them. column options, row_filters and the
+#                    column partition key strategy don't apply (records are keyed by index instead),
+#                    chunk_bytes sizes the blocks read
+#     pass_through_header - optional boolean, sends the header line of a pass-through file with a header as its
+#                           first record instead of dropping it, with the columns renamed by column_renames
+#                           (old:new pairs, e.g. "visid_high:visitor_id")
+#     local_workers - optional, number of processes sending an uncompressed local/NAS file: the file is memory
+#                     mapped and split into that many byte ranges at line ends, each sent by its own process.
+#                     a zipped file or one with a compressed extension (.gz, .zip, .bz2, ...) is streamed instead
+#     parser_engine - optional, pandas (default) or pyarrow, the multi-threaded pyarrow csv reader (when installed)
+#                     for the comma, tab and pipe formats. with chunk_bytes it reads blocks of chunk_bytes bytes
+#     checkpoint_interval_rows - optional, saves the rows acknowledged by kinesis in the metastore every this many
+#                                rows, a failed file picked up again resumes from there instead of row zero
+#     dest_record_format - optional, json (default) or pipe, layout of the records sent to kinesis
+#     dest_sink - optional, kinesis (default), kafka or file: sends the records to the kafka topic (on the brokers
+#                 of dest_kafka_servers, comma separated host:port) or appends them to the local file (- for
+#                 stdout, e.g. to benchmark without a stream) named by dest_kds_stream
+#     max_in_flight_requests - optional, number of concurrent put_records calls (default 1, at most 32)
+#     max_put_attempts - optional, attempts for records failed/throttled by put_records (default 5)
+#     shard_mb_per_sec - optional, paces sending to this many MB/s per shard of dest_kds_stream (at most 1)
+#     partition_key_strategy - optional, index (default), column, hash (spread evenly over the shards) or random
+#     partition_key_column - column used as partition key by the column strategy, e.g. visitor id, sends the
+#                            records of a key to one shard (retried records may arrive after later ones)
+#     aggregate_records - optional boolean, packs rows into KPL aggregated records (read them with
+#                         kpl_aggregation.deaggregate_record or a KCL consumer)
+#     aggregation_max_bytes - optional, size of an aggregated record (default 51200)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='s3_to_kinesis_data_pumper',
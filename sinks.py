@@ -0,0 +1,276 @@
+# batched record sinks shared by the producers: kinesis data streams, kafka topics and newline delimited
+# files (or stdout) for offline benchmarking without a stream. a record is a byte payload with a key, the
+# partition key in kinesis and the message key in kafka (files ignore it). add()/add_records() buffer
+# records and send them once a batch is full, flush() sends the rest and waits until everything sent was
+# acknowledged. every sink counts the same sent_bytes and delivered/retried/dropped records
+# (see counters()) and its throughput since it was opened (see summary())
+import abc
+import logging
+import sys
+import threading
+import time
+from collections import deque
+from kinesis_sender import get_batch_limits, pack_batches, PutRecordsPipeline, MAX_PUT_ATTEMPTS, \
+    MAX_RECORDS_PER_REQUEST, MAX_BYTES_PER_REQUEST
+
+# destinations of create_sink
+SINK_TYPES = ('kinesis', 'kafka', 'file')
+# seconds kafka gets to acknowledge a batch
+KAFKA_SEND_TIMEOUT = 60
+
+
+class RecordSink(abc.ABC):
+    def __init__(self, name, max_batch_records=MAX_RECORDS_PER_REQUEST, max_batch_bytes=MAX_BYTES_PER_REQUEST):
+        self.name = name
+        self.max_batch_records = max_batch_records
+        self.max_batch_bytes = max_batch_bytes
+        self.payloads = []
+        self.keys = []
+        self.explicit_hash_keys = []
+        self.buffered_bytes = 0
+        self.sent_batches = 0
+        self.sent_bytes = 0
+        self.delivered_records = 0
+        self.retried_records = 0
+        self.dropped_records = 0
+        self.started = time.monotonic()
+
+    def __repr__(self):
+        return "<%s name=%r buffered=%d>" % (type(self).__name__, self.name, len(self.payloads))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel=exc_type is not None)
+
+    def add(self, payload, key=None, explicit_hash_key=None):
+        self.payloads.append(payload)
+        self.keys.append(key)
+        self.explicit_hash_keys.append(explicit_hash_key)
+        self.buffered_bytes = self.buffered_bytes + len(payload) + (len(key) if key else 0)
+        if len(self.payloads) >= self.max_batch_records or self.buffered_bytes >= self.max_batch_bytes:
+            self._send_buffered()
+
+    # buffers many records at once, e.g. a serialized dataframe. sizes are the sizes of the payloads
+    # when they are known already
+    def add_records(self, payloads, keys=None, explicit_hash_keys=None, sizes=None):
+        if not payloads:
+            return
+        self.payloads.extend(payloads)
+        self.keys.extend(keys if keys is not None else [None] * len(payloads))
+        self.explicit_hash_keys.extend(explicit_hash_keys if explicit_hash_keys is not None
+                                       else [None] * len(payloads))
+        self.buffered_bytes = self.buffered_bytes + sum(sizes if sizes is not None else map(len, payloads))
+        if len(self.payloads) >= self.max_batch_records or self.buffered_bytes >= self.max_batch_bytes:
+            self._send_buffered()
+
+    def flush(self):
+        if self.payloads:
+            self._send_buffered()
+        self._wait()
+
+    def close(self, cancel=False):
+        if not cancel:
+            self.flush()
+
+    # bytes and delivered/retried/dropped record counts of everything acknowledged so far, the same
+    # counters as PutRecordsPipeline.counters()
+    def counters(self):
+        return {'sent_bytes': self.sent_bytes, 'delivered_records': self.delivered_records,
+                'retried_records': self.retried_records, 'dropped_records': self.dropped_records}
+
+    # the counters with the records and MB per second since the sink was opened
+    def summary(self):
+        counters = self.counters()
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return "{} records ({:.2f} MB) to {} in {} batches, {:.0f} records/s, {:.2f} MB/s, retried {}, " \
+               "dropped {}".format(counters['delivered_records'], counters['sent_bytes'] / 1048576.0, self.name,
+                                   self.sent_batches, counters['delivered_records'] / elapsed,
+                                   counters['sent_bytes'] / 1048576.0 / elapsed, counters['retried_records'],
+                                   counters['dropped_records'])
+
+    def _send_buffered(self):
+        (payloads, keys, explicit_hash_keys) = (self.payloads, self.keys, self.explicit_hash_keys)
+        (self.payloads, self.keys, self.explicit_hash_keys, self.buffered_bytes) = ([], [], [], 0)
+        self._send_batch(payloads, keys, explicit_hash_keys)
+
+    # sends the buffered records, may return before they are acknowledged
+    @abc.abstractmethod
+    def _send_batch(self, payloads, keys, explicit_hash_keys):
+        pass
+
+    # waits until the records sent so far are acknowledged
+    def _wait(self):
+        pass
+
+
+# puts records to a kinesis data stream with a PutRecordsPipeline: batches within the put_records limits
+# (and what shard_count shards take per second), up to max_in_flight calls at a time, failed entries
+# retried up to max_attempts times. records without a key use their position as partition key
+class KinesisSink(RecordSink):
+    def __init__(self, kinesis_client, stream_name, max_in_flight=1, max_attempts=MAX_PUT_ATTEMPTS, limiter=None,
+                 shard_count=None):
+        (max_records, max_bytes) = get_batch_limits(shard_count)
+        super().__init__(stream_name, max_records, max_bytes)
+        self.pipeline = PutRecordsPipeline(kinesis_client, stream_name, max_in_flight, max_attempts=max_attempts,
+                                           limiter=limiter)
+        self.record_count = 0
+
+    def _send_batch(self, payloads, keys, explicit_hash_keys):
+        partition_keys = [key if key else str(self.record_count + position) for (position, key) in enumerate(keys)]
+        self.record_count = self.record_count + len(payloads)
+        if all(hash_key is None for hash_key in explicit_hash_keys):
+            explicit_hash_keys = None
+        for (records, batch_bytes) in pack_batches(payloads, [len(payload) for payload in payloads], partition_keys,
+                                                   self.max_batch_records, self.max_batch_bytes, explicit_hash_keys):
+            # blocks only when max_in_flight batches are queued
+            self.pipeline.submit(records, batch_bytes)
+
+    def _wait(self):
+        self.pipeline.flush()
+        self.sent_batches = self.pipeline.sent_batches
+
+    def counters(self):
+        return self.pipeline.counters()
+
+    def close(self, cancel=False):
+        try:
+            super().close(cancel)
+        finally:
+            self.pipeline.close(cancel=cancel)
+
+
+# sends records to a kafka topic with a kafka-python KafkaProducer (sending bytes, without a value
+# serializer). the records of a batch are handed to the producer, which batches them per partition.
+# by default the delivery of a batch is awaited once per batch instead of once per record. with
+# max_outstanding the sends stay asynchronous: deliveries are counted by callbacks, add() only blocks
+# when max_outstanding records are unacknowledged and flush() waits for the rest (producer.flush())
+class KafkaSink(RecordSink):
+    def __init__(self, producer, topic, max_batch_records=MAX_RECORDS_PER_REQUEST, send_timeout=KAFKA_SEND_TIMEOUT,
+                 max_outstanding=None):
+        super().__init__(topic, max_batch_records, sys.maxsize)
+        self.producer = producer
+        self.send_timeout = send_timeout
+        self.max_outstanding = max_outstanding
+        self.outstanding = deque()  # futures of the records sent asynchronously, oldest first
+        self.lock = threading.Lock()  # the callbacks run in the i/o thread of the producer
+
+    def _send_batch(self, payloads, keys, explicit_hash_keys):
+        if self.max_outstanding:
+            self._send_async(payloads, keys)
+            return
+        futures = []
+        for (payload, key) in zip(payloads, keys):
+            futures.append((self.producer.send(self.name, key=key.encode('utf-8') if key else None, value=payload),
+                            len(payload)))
+        self.sent_batches = self.sent_batches + 1
+        for (future, size) in futures:
+            try:
+                future.get(timeout=self.send_timeout)
+            except Exception as e:
+                self._failed(e)
+            else:
+                self._delivered(size, None)
+
+    def _send_async(self, payloads, keys):
+        for (payload, key) in zip(payloads, keys):
+            future = self.producer.send(self.name, key=key.encode('utf-8') if key else None, value=payload)
+            future.add_callback(self._delivered, len(payload))
+            future.add_errback(self._failed)
+            self.outstanding.append(future)
+            while self.outstanding and self.outstanding[0].is_done:
+                self.outstanding.popleft()
+            if len(self.outstanding) > self.max_outstanding:
+                # backpressure, the errback counts a failure
+                try:
+                    self.outstanding.popleft().get(timeout=self.send_timeout)
+                except Exception:
+                    pass
+        self.sent_batches = self.sent_batches + 1
+
+    def _delivered(self, size, metadata):
+        with self.lock:
+            self.delivered_records = self.delivered_records + 1
+            self.sent_bytes = self.sent_bytes + size
+
+    def _failed(self, error):
+        with self.lock:
+            self.dropped_records = self.dropped_records + 1
+        logging.error("Error while trying to send data to {}, error message:{}".format(self.name, error))
+
+    def _wait(self):
+        if self.outstanding:
+            self.producer.flush(timeout=self.send_timeout)
+            self.outstanding.clear()
+
+    def counters(self):
+        with self.lock:
+            return super().counters()
+
+    def close(self, cancel=False):
+        super().close(cancel)
+        if not cancel:
+            self.producer.flush()
+
+
+# writes the payloads as lines of a file (appended) or of stdout ('-'), one record per line. with file, an
+# open binary file shared with other sinks (see open_sink_client), the lines are written there and the file
+# is left open: a batch is a single write, which a buffered file does whole even from several threads
+class FileSink(RecordSink):
+    def __init__(self, path, max_batch_records=MAX_RECORDS_PER_REQUEST, file=None):
+        super().__init__(path, max_batch_records)
+        self.owns_file = file is None
+        self.file = file if file is not None else open_sink_client('file', path)
+
+    def _send_batch(self, payloads, keys, explicit_hash_keys):
+        data = b'\n'.join(payloads) + b'\n'
+        self.file.write(data)
+        self.sent_batches = self.sent_batches + 1
+        self.sent_bytes = self.sent_bytes + len(data)
+        self.delivered_records = self.delivered_records + len(payloads)
+
+    def _wait(self):
+        self.file.flush()
+
+    def close(self, cancel=False):
+        try:
+            super().close(cancel)
+        finally:
+            if self.owns_file and self.file is not sys.stdout.buffer:
+                self.file.close()
+
+
+# the client a sink of one of SINK_TYPES on name sends with, thread safe so sinks of several threads can
+# share it:
+#   kinesis - a kinesis client for region_name
+#   kafka   - a KafkaProducer on bootstrap_servers with producer_options (kafka-python is only needed for
+#             kafka sinks)
+#   file    - the file at path name opened for appending, stdout for '-'
+def open_sink_client(sink_type, name, region_name=None, bootstrap_servers=None, producer_options=None):
+    if sink_type == 'kinesis':
+        import boto3
+        return boto3.client('kinesis', region_name=region_name)
+    if sink_type == 'kafka':
+        from kafka import KafkaProducer
+        return KafkaProducer(bootstrap_servers=bootstrap_servers or ['localhost:9092'], **(producer_options or {}))
+    if sink_type == 'file':
+        return sys.stdout.buffer if name == '-' else open(name, 'ab')
+    raise ValueError("unknown sink {}, supported sinks are {}".format(sink_type, SINK_TYPES))
+
+
+# opens a sink of one of SINK_TYPES on name (stream, topic or path) with options of its class, on client
+# when given (kinesis_client for kinesis) or on a client of its own (see open_sink_client). a client that
+# is passed in is shared: closing the sink flushes it but does not close it
+def create_sink(sink_type, name, region_name=None, kinesis_client=None, bootstrap_servers=None,
+                producer_options=None, client=None, **options):
+    if sink_type not in SINK_TYPES:
+        raise ValueError("unknown sink {}, supported sinks are {}".format(sink_type, SINK_TYPES))
+    client = client if client is not None else kinesis_client if sink_type == 'kinesis' else None
+    if sink_type == 'file':
+        return FileSink(name, file=client, **options)
+    if client is None:
+        client = open_sink_client(sink_type, name, region_name, bootstrap_servers, producer_options)
+    if sink_type == 'kinesis':
+        return KinesisSink(client, name, **options)
+    return KafkaSink(client, name, **options)
@@ -1,9 +1,31 @@
 import boto3
 import logging
 import argparse
+import multiprocessing
+import threading
 import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from botocore.exceptions import ClientError
 import s3_to_kinesis
 
+# sqs limits for receive_message and the *_batch calls
+MAX_SQS_BATCH = 10
+MAX_WAIT_TIME_SECONDS = 20
+# seconds between short polls while some workers are busy and others are free
+BUSY_POLL_SECONDS = 5
+# first retry delay of a failed file, doubled on every receive
+RETRY_DELAY_SECONDS = 30
+# longest visibility timeout sqs accepts
+MAX_VISIBILITY_TIMEOUT = 43200
+# outcomes of process_file
+FILE_PROCESSED = 'processed'
+FILE_FAILED = 'failed'
+FILE_IN_PROGRESS = 'in_progress'
+
+Message = namedtuple('Message', 'body receipt_handle receive_count')
+
 sqs = boto3.client("sqs")
 
 
@@ -13,24 +35,225 @@ def get_queue_url(q_name):
     return q
 
 
-def receive_message(q_url):
-    response = sqs.receive_message(
-        QueueUrl=q_url,
-        MaxNumberOfMessages=1,
-        WaitTimeSeconds=10,
-    )
+# long polls up to max_messages messages, an empty poll returns an empty list
+def receive_messages(q_url, max_messages=MAX_SQS_BATCH, wait_time=MAX_WAIT_TIME_SECONDS, visibility_timeout=None):
+    request = {
+        'QueueUrl': q_url,
+        'MaxNumberOfMessages': max_messages,
+        'WaitTimeSeconds': wait_time,
+        'AttributeNames': ['ApproximateReceiveCount']
+    }
+    if visibility_timeout:
+        request['VisibilityTimeout'] = visibility_timeout
+    response = sqs.receive_message(**request)
 
     logging.info(f"Number of messages received: {len(response.get('Messages', []))}")
-    for message in response.get("Messages", []):
-        return message["Body"], message['ReceiptHandle']
+    return [Message(message["Body"], message['ReceiptHandle'],
+                    int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1)))
+            for message in response.get("Messages", [])]
+
+
+# keeps messages whose files are still being processed invisible to other workers
+def extend_visibility(q_url, receipt_handles, visibility_timeout):
+    for start in range(0, len(receipt_handles), MAX_SQS_BATCH):
+        entries = [{'Id': str(i), 'ReceiptHandle': receipt_handle, 'VisibilityTimeout': visibility_timeout}
+                   for (i, receipt_handle) in enumerate(receipt_handles[start:start + MAX_SQS_BATCH])]
+        response = sqs.change_message_visibility_batch(QueueUrl=q_url, Entries=entries)
+        for failed in response.get('Failed', []):
+            logging.error(f"Unable to extend visibility of message {failed['Id']}: {failed.get('Message')}")
+
+
+def delete_messages(q_url, receipt_handles):
+    for start in range(0, len(receipt_handles), MAX_SQS_BATCH):
+        entries = [{'Id': str(i), 'ReceiptHandle': receipt_handle}
+                   for (i, receipt_handle) in enumerate(receipt_handles[start:start + MAX_SQS_BATCH])]
+        response = sqs.delete_message_batch(QueueUrl=q_url, Entries=entries)
+        for failed in response.get('Failed', []):
+            logging.error(f"Unable to delete message {failed['Id']}: {failed.get('Message')}")
+
+
+# holds the lease of the messages whose files are being processed: a background thread heartbeats
+# ChangeMessageVisibility every third of the visibility timeout, so a file that takes longer than the
+# visibility timeout of the queue is not redelivered to (and re-sent to kinesis by) another worker
+class MessageLeaseManager:
+    def __init__(self, q_url, visibility_timeout):
+        self.q_url = q_url
+        self.visibility_timeout = visibility_timeout
+        self.receipt_handles = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._heartbeat, name="sqs-lease-heartbeat", daemon=True)
+
+    def __repr__(self):
+        return "<%s q_url=%r leases=%d>" % (type(self).__name__, self.q_url, len(self.receipt_handles))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+    def add(self, receipt_handle):
+        with self.lock:
+            self.receipt_handles.add(receipt_handle)
+
+    def remove(self, receipt_handle):
+        with self.lock:
+            self.receipt_handles.discard(receipt_handle)
+
+    # extends the leases under the lock: a message removed meanwhile would otherwise have its visibility
+    # extended after it was deleted or given its retry delay by handle_failed_message, so remove() waits
+    # for the extension in flight
+    def _heartbeat(self):
+        while not self.stopped.wait(self.visibility_timeout / 3.0):
+            with self.lock:
+                receipt_handles = list(self.receipt_handles)
+                if not receipt_handles:
+                    continue
+                try:
+                    extend_visibility(self.q_url, receipt_handles, self.visibility_timeout)
+                except ClientError as e:
+                    logging.error(f"Unable to extend visibility of {len(receipt_handles)} messages: {e}")
+
+
+# a file that failed max_receives times is routed to the poison queue (or, without one, left to the
+# redrive policy of the queue) instead of being retried forever, earlier failures are retried after
+# an exponential backoff rather than after the whole visibility timeout
+def handle_failed_message(q_url, message, visibility_timeout, max_receives, poison_queue_url=None):
+    if message.receive_count >= max_receives:
+        if poison_queue_url:
+            sqs.send_message(QueueUrl=poison_queue_url, MessageBody=message.body)
+            delete_messages(q_url, [message.receipt_handle])
+            logging.error(f"{message.body} failed {message.receive_count} times, moved to {poison_queue_url}")
+            return
+        logging.error(f"{message.body} failed {message.receive_count} times, left to the redrive policy of the queue")
+    delay = min(visibility_timeout, RETRY_DELAY_SECONDS * 2 ** (message.receive_count - 1))
+    sqs.change_message_visibility(QueueUrl=q_url, ReceiptHandle=message.receipt_handle, VisibilityTimeout=delay)
+    logging.info(f"{message.body} left on the queue for a retry in {delay} seconds")
+
+
+# a file claimed by another attempt is not a failure, its message is hidden until the claim of that
+# attempt would expire (or for visibility_timeout when that is not known) and never routed aside
+def delay_message(q_url, message, claim_expires, visibility_timeout):
+    delay = visibility_timeout if claim_expires is None else int(claim_expires - time.time())
+    delay = min(max(delay, RETRY_DELAY_SECONDS), MAX_VISIBILITY_TIMEOUT)
+    sqs.change_message_visibility(QueueUrl=q_url, ReceiptHandle=message.receipt_handle, VisibilityTimeout=delay)
+    logging.info(f"{message.body} is being processed by another attempt, checking again in {delay} seconds")
+
+
+# config items of the files of a batch of messages read with one batch_get_item, served from the
+# config cache of this long running process when they were read recently
+def prefetch_configs(config_table, service_type, messages):
+    try:
+        return s3_to_kinesis.prefetch_configs(config_table, service_type,
+                                              [s3_to_kinesis.get_s3_location_path(message.body)
+                                               for message in messages])
+    except Exception as e:
+        logging.error(f"Unable to prefetch configs, the workers read them one by one: {e}")
+        return {}
+
+
+# runs in a worker process, run_process exits on failure so that is turned into a return value.
+# a file that was already sent (redelivered message, duplicate notification) counts as processed, a file
+# claimed by another attempt is left on the queue for a retry as that attempt may still fail.
+# returns the outcome (FILE_PROCESSED, FILE_FAILED or FILE_IN_PROGRESS) and, for a file in progress, the
+# epoch second the claim on it expires at (None when not known)
+def process_file(config_table, meta_table, service_type, file_path, dynamo_config=None):
+    try:
+        if not s3_to_kinesis.run_process(config_table, meta_table, service_type, file_path, dynamo_config):
+            logging.info(f"{file_path} was already processed, dropping the message")
+    except s3_to_kinesis.FileInProgress as e:
+        logging.info(f"{e}, leaving the message for a retry")
+        return FILE_IN_PROGRESS, e.claim_expires
+    except (Exception, SystemExit) as e:
+        logging.error(f"Processing of {file_path} failed: {e!r}")
+        return FILE_FAILED, None
+    return FILE_PROCESSED, None
+
+
+# a pool of `workers` processes, spawned as the boto3 clients created at import must not be shared with
+# forked children
+def create_executor(workers):
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+# processes up to `workers` files at a time in a process pool. messages are received in batches
+# of up to 10 with long polling whenever a worker is free, the config items of their files are
+# prefetched in one batch_get_item, their lease is held by a
+# MessageLeaseManager while their file is processed, and messages of files that were sent to
+# kinesis are deleted in batches. failed files go through handle_failed_message, files claimed by
+# another attempt through delay_message.
+# a worker process that dies (e.g. killed out of memory) breaks the pool: the messages of all the files
+# in flight go through handle_failed_message and the pool is replaced by a new one
+def run_workers(queue_url, config_table, meta_table, service_type, workers, visibility_timeout, max_receives,
+                poison_queue_url=None):
+    in_progress = {}  # future -> message
+    executor = create_executor(workers)
+    try:
+        with MessageLeaseManager(queue_url, visibility_timeout) as leases:
+            while True:
+                free_workers = workers - len(in_progress)
+                if free_workers > 0:
+                    # block on the queue only when idle, otherwise just pick up what is waiting
+                    wait_time = 0 if in_progress else MAX_WAIT_TIME_SECONDS
+                    messages = receive_messages(queue_url, min(MAX_SQS_BATCH, free_workers), wait_time,
+                                                visibility_timeout)
+                    configs = prefetch_configs(config_table, service_type, messages) if messages else {}
+                    for message in messages:
+                        leases.add(message.receipt_handle)
+                        config = configs.get(s3_to_kinesis.get_s3_location_path(message.body))
+                        try:
+                            future = executor.submit(process_file, config_table, meta_table, service_type,
+                                                     message.body, config)
+                        except BrokenProcessPool:
+                            executor = replace_broken_executor(executor, workers, in_progress, leases, queue_url,
+                                                               visibility_timeout, max_receives, poison_queue_url)
+                            future = executor.submit(process_file, config_table, meta_table, service_type,
+                                                     message.body, config)
+                        in_progress[future] = message
+                if not in_progress:
+                    continue
+                timeout = BUSY_POLL_SECONDS if workers > len(in_progress) else None
+                (done, _) = wait(in_progress, timeout=timeout, return_when=FIRST_COMPLETED)
+                processed = []
+                broken = False
+                for future in done:
+                    message = in_progress.pop(future)
+                    leases.remove(message.receipt_handle)
+                    try:
+                        (outcome, claim_expires) = future.result()
+                    except BrokenProcessPool as e:
+                        logging.error(f"Worker process of {message.body} died: {e}")
+                        (outcome, broken) = (FILE_FAILED, True)
+                    if outcome == FILE_PROCESSED:
+                        processed.append(message.receipt_handle)
+                    elif outcome == FILE_IN_PROGRESS:
+                        delay_message(queue_url, message, claim_expires, visibility_timeout)
+                    else:
+                        handle_failed_message(queue_url, message, visibility_timeout, max_receives, poison_queue_url)
+                if processed:
+                    delete_messages(queue_url, processed)
+                if broken:
+                    executor = replace_broken_executor(executor, workers, in_progress, leases, queue_url,
+                                                       visibility_timeout, max_receives, poison_queue_url)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
-def delete_message(q_url, receipt_handle):
-    response = sqs.delete_message(
-        QueueUrl=q_url,
-        ReceiptHandle=receipt_handle,
-    )
-    print(response)
+# shuts a broken pool down, hands the messages of the files it still had in flight to handle_failed_message
+# (the broken pool terminated their processes) and returns a new pool
+def replace_broken_executor(executor, workers, in_progress, leases, q_url, visibility_timeout, max_receives,
+                            poison_queue_url=None):
+    executor.shutdown(wait=False, cancel_futures=True)
+    for (future, message) in list(in_progress.items()):
+        del in_progress[future]
+        leases.remove(message.receipt_handle)
+        logging.error(f"Processing of {message.body} was interrupted by a broken worker pool")
+        handle_failed_message(q_url, message, visibility_timeout, max_receives, poison_queue_url)
+    logging.info(f"Starting a new pool of {workers} worker processes")
+    return create_executor(workers)
 
 
 def main(args):
@@ -39,12 +262,9 @@ def main(args):
     meta_table = args.metastore
     service_type = args.service
     queue_url = get_queue_url(queue_name)
-    while True:
-        (file_path, receipt_handle) = receive_message(queue_url)
-        s3_to_kinesis.run_process(config_table, meta_table, service_type,
-                                  file_path)
-        delete_message(queue_url, receipt_handle)
-        time.sleep(60)
+    poison_queue_url = get_queue_url(args.poison_queue_name) if args.poison_queue_name else None
+    run_workers(queue_url, config_table, meta_table, service_type, args.workers, args.visibility_timeout,
+                args.max_receives, poison_queue_url)
 
 
 # This script polls a sqs to receive a absolute file path in s3
@@ -54,6 +274,10 @@ def main(args):
 #     config      - name of the dynamo db config table
 #     metastore   - name of the metatore table of dynamo db
 #     service     - defaulted to lambda, this is the primary key in dynamodb config table
+#     workers     - number of files processed concurrently in a process pool
+#     visibility_timeout - seconds a received message stays invisible, extended while its file is processed
+#     max_receives - number of failed attempts after which a file is routed aside
+#     poison_queue_name - optional sqs queue receiving the files that failed max_receives times
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='sqs_to_process_triggers',
                                      description='Reads the file name from SQS and trigger python process to read the '
@@ -68,5 +292,13 @@ if __name__ == '__main__':
     parser.add_argument('--service', action="store", type=str,
                         default="lambda",
                         help="configuration for service")
+    parser.add_argument('--workers', action="store", type=int, default=1,
+                        help="number of files processed concurrently")
+    parser.add_argument('--visibility_timeout', action="store", type=int, default=300,
+                        help="visibility timeout in seconds of the received messages")
+    parser.add_argument('--max_receives', action="store", type=int, default=3,
+                        help="number of failed attempts after which a file is routed aside")
+    parser.add_argument('--poison_queue_name', action="store", type=str, default=None,
+                        help="sqs queue name for files that keep failing")
 
     main(parser.parse_args())